@@ -7,6 +7,7 @@ import datetime
 import os.path
 import urllib.request
 
+from python3.shipper.config import get_config
 from python3.shipper.shipper import LogzioShipper
 
 FIELD_NAMES = ('date', 'time', 'x-edge-location', 'sc-bytes', 'c-ip', 'cs-method', 'cs\(Host)', 'cs-uri-stem', 'sc-status', 'cs\(Referer)', 'cs\(User-Agent)', 'cs-uri-query',	'cs\(Cookie)', 'x-edge-result-type', 'x-edge-request-id', 'x-host-header', 'cs-protocol', 'cs-bytes', 'time-taken',
@@ -36,24 +37,26 @@ def get_amplify_access_log_link(access_logs_starttime, access_logs_endtime):
             f'Error occurred while trying get access url please check your credentials: {e}.')
 
 
-def convert_csv_to_array_of_logs(log_url):
-    json_array = []
+def read_access_logs(log_url):
+    # type: (str) -> list
+    logs = []
 
     try:
         response = urllib.request.urlopen(log_url)
         lines = [l.decode('utf-8') for l in response.readlines()]
-        reader = csv.DictReader(lines, FIELD_NAMES)
-
-        for row in reader:
-            json_array.append(json.dumps(row))
+        logs = list(csv.DictReader(lines, FIELD_NAMES))
 
-        if len(json_array) > 0:
-            json_array.pop(0)
+        if len(logs) > 0:
+            logs.pop(0)
     except Exception as e:
         logger.warning(
             f'Error occurred while trying convert csv to array of logs: {e}.')
 
-    return json_array
+    return logs
+
+
+def convert_csv_to_array_of_logs(log_url):
+    return [json.dumps(row) for row in read_access_logs(log_url)]
 
 
 def _extract_aws_amplify_logs_data(event):
@@ -69,7 +72,7 @@ def _extract_aws_amplify_logs_data(event):
         log_url = get_amplify_access_log_link(
             access_logs_starttime, access_logs_endtime)
 
-        logs = convert_csv_to_array_of_logs(log_url)
+        logs = read_access_logs(log_url)
 
         return logs
 
@@ -88,8 +91,8 @@ def _add_timestamp(log):
     return log
 
 
-def _get_additional_logs_data(log, context):
-    # type: (dict, 'LambdaContext') -> dict
+def _get_additional_logs_data(log, context, config=None):
+    # type: (dict, 'LambdaContext', RuntimeConfig) -> dict
     try:
         log['function_version'] = context.function_version
         log['invoked_function_arn'] = context.invoked_function_arn
@@ -97,9 +100,10 @@ def _get_additional_logs_data(log, context):
         logger.info(
             'Failed to find context value. Continue without adding it to the log')
 
-    try:
-        log['type'] = os.environ['TYPE']
-    except KeyError:
+    log_type = (config or get_config()).log_type
+    if log_type is not None:
+        log['type'] = log_type
+    else:
         logger.info(f"Using default TYPE {DEFAULT_TYPE}.")
         log['type'] = DEFAULT_TYPE
     return log
@@ -109,20 +113,12 @@ def lambda_handler(event, context):
     # type (dict, 'LambdaContext') -> None
 
     aws_logs_data = _extract_aws_amplify_logs_data(event)
-    shipper = LogzioShipper()
+    shipper = LogzioShipper(context)
 
     logger.info("About to send {} logs".format(
         len(aws_logs_data)))
-    for log in aws_logs_data:
-        try:
-            json_log = json.loads(log)
-        except Exception as e:
-            logger.warning(
-                f'Error occurred while trying to parse log to JSON: {e}.')
-            continue
-
-        json_log = _get_additional_logs_data(json_log, context)
-        json_log = _add_timestamp(json_log)
-        shipper.add(json_log)
+    # Rows are kept as dicts, so every log is serialized once, by the shipper
+    config = get_config()
+    shipper.add_many(_add_timestamp(_get_additional_logs_data(log, context, config)) for log in aws_logs_data)
 
     shipper.flush()
@@ -1,195 +1,275 @@
 import base64
-import gzip
+import codecs
+import itertools
 import json
-from dateutil import parser
-import os
-from io import BytesIO
+import re
+import zlib
 
+from python3.shipper.cloudwatch_logs import LOGS_DATA_HEADER_FIELDS, classify_payload, plan_cache, ship_logs
+from python3.shipper.config import get_config
+from python3.shipper.metrics import metrics
+from python3.shipper.parallel import ship_in_parallel
 from python3.shipper.shipper import LogzioShipper
+from python3.shipper.spool import get_spool
 from python3.custom_logger import custom_logger
 
-KEY_INDEX = 0
-VALUE_INDEX = 1
-LOG_LEVELS = ['ALERT', 'TRACE', 'DEBUG', 'NOTICE', 'INFO', 'WARN',
-              'WARNING', 'ERROR', 'ERR', 'CRITICAL', 'CRIT',
-              'FATAL', 'SEVERE', 'EMERG', 'EMERGENCY']
-
-LOG_GROUP_TO_PREFIX = {
-    "/aws/apigateway/": "aws/apigateway",
-    "/aws/rds/cluster/": "aws/rds",
-    "/aws/cloudhsm/": "aws/cloudhsm",
-    "aws-cloudtrail-logs-": "aws/cloudtrail",
-    "/aws/codebuild/": "aws/codebuild",
-    "/aws/connect/": "aws/connect",
-    "/aws/elasticbeanstalk/": "aws/elasticbeanstalk",
-    "/aws/ecs/": "aws/ecs",
-    "/aws/eks/": "aws/eks",
-    "/aws-glue/": "glue",
-    "AWSIotLogsV2": "aws/iot",
-    "/aws/lambda/": "aws/lambda",
-    "/aws/macie/": "aws/macie",
-    "/aws/amazonmq/broker/": "aws/amazonmq"
-}
-
-PYTHON_EVENT_SIZE = 3
-NODEJS_EVENT_SIZE = 4
-LAMBDA_LOG_GROUP = '/aws/lambda/'
+# Payload is decoded this many base64 characters at a time, must be a multiple of 4
+BASE64_CHUNK_SIZE = 64 * 1024
+DECOMPRESS_CHUNK_SIZE = 64 * 1024
+JSON_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+# Characters that continue a number, which raw_decode stops before when a chunk splits the number there
+NUMBER_CONTINUATION_CHARS = frozenset('.eE0123456789+-')
 
 
 # set logger
 logger = custom_logger.get_logger(__name__)
 
 
-def _extract_aws_logs_data(event):
-    # type: (dict) -> dict
-    event_str = event['awslogs']['data']
-    try:
-        logs_data_decoded = base64.b64decode(event_str)
-        logs_data_unzipped = gzip.GzipFile(fileobj=BytesIO(logs_data_decoded))
-        logs_data_unzipped = logs_data_unzipped.read()
-        logs_data_dict = json.loads(logs_data_unzipped)
-        return logs_data_dict
-    except ValueError as e:
-        logger.error("Got exception while loading json, message: {}".format(e))
-        raise ValueError("Exception: json loads")
+class AwsLogsDataStream(object):
+    """Incremental decoder of a base64 encoded, gzip compressed CloudWatch Logs subscription payload.
 
+    read_header() returns the payload fields, and events() then decodes the log
+    events one at a time while the payload is inflated, so memory is bounded by
+    the biggest event rather than by the whole payload. If the payload fields
+    come after logEvents, the events are kept in memory until they are known.
+    """
+    _json_decoder = json.JSONDecoder()
 
-def _extract_lambda_log_message(log):
-    # type: (dict) -> None
-    str_message = str(log['message'])
-    try:
-        start_level = str_message.index('[')
-        end_level = str_message.index(']')
-        log_level = str_message[start_level + 1:end_level].upper()
-        if log_level in LOG_LEVELS:
-            log['log_level'] = log_level
-            start_split = end_level + 2
+    def __init__(self, data, base64_chunk_size=BASE64_CHUNK_SIZE, decompress_chunk_size=DECOMPRESS_CHUNK_SIZE):
+        # type: (str | bytes, int, int) -> None
+        self._data = data
+        self._data_pos = 0
+        self._base64_chunk_size = base64_chunk_size
+        self._decompress_chunk_size = decompress_chunk_size
+        self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._header = None
+        self._buffered_events = None
+        self._streaming_events = False
+
+    def _next_compressed_chunk(self):
+        chunk = self._data[self._data_pos:self._data_pos + self._base64_chunk_size]
+        self._data_pos += len(chunk)
+        return base64.b64decode(chunk) if chunk else b''
+
+    def _inflate(self):
+        # type: () -> bytes | None
+        """The next decompressed bytes, or None at the end of the payload."""
+        while True:
+            if self._inflater.eof:
+                # Concatenated gzip members, as GzipFile reads them
+                compressed = self._inflater.unused_data or self._next_compressed_chunk()
+                if not compressed:
+                    return None
+                self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif self._inflater.unconsumed_tail:
+                compressed = self._inflater.unconsumed_tail
+            else:
+                compressed = self._next_compressed_chunk()
+                if not compressed:
+                    if self._data_pos:
+                        raise ValueError("Compressed payload ended unexpectedly")
+                    return None
+            decompressed = self._inflater.decompress(compressed, self._decompress_chunk_size)
+            if decompressed:
+                return decompressed
+
+    def _fill(self):
+        # type: () -> bool
+        if self._eof:
+            return False
+        decompressed = self._inflate()
+        if decompressed is None:
+            self._eof = True
+            text = self._text_decoder.decode(b'', final=True)
         else:
-            start_split = 0
-    except ValueError:
-        # Let's try without log level
-        start_split = 0
-    message_parts = str_message[start_split:].split('\t')
-    size = len(message_parts)
-    if size == PYTHON_EVENT_SIZE or size == NODEJS_EVENT_SIZE:
-        try:
-            # Parser only to check if timestamp for Python and NodeJS is pass without
-			# error, if not skip unparsing log and send as log message.
-            parser.parse(message_parts[0])
-            log['@timestamp'] = message_parts[0]
-            log['requestID'] = message_parts[1]
-            log['message'] = message_parts[size - 1]
-            if size == NODEJS_EVENT_SIZE:
-                log['log_level'] = message_parts[2]
-        except Exception as e:
-            logger.warning(
-                f'Error occurred while trying to parse log time: {e}.')
-            pass
+            text = self._text_decoder.decode(decompressed)
+        # Drop what was already parsed, only the current value is kept
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        return True
 
+    def _peek(self):
+        # type: () -> str
+        while True:
+            self._pos = JSON_WHITESPACE_RE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
 
-def _add_timestamp(log):
-    # type: (dict) -> None
-    if '@timestamp' not in log:
-        log['@timestamp'] = str(log['timestamp'])
-        del log['timestamp']
+    def _expect(self, chars):
+        # type: (str) -> str
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of '{}' at payload position {} but found '{}'".format(
+                chars, self._pos, char))
+        self._pos += 1
+        return char
 
+    def _read_value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._pos)
+                # A value that ends with the buffer, like a number, may continue in the next chunk,
+                # and a number split after "12." or "1e" is decoded without its rest
+                if self._eof or (end < len(self._buffer) and not (
+                        isinstance(value, (int, float)) and not isinstance(value, bool) and
+                        self._buffer[end] in NUMBER_CONTINUATION_CHARS)):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
 
-def _parse_to_json(log):
-    # type: (dict) -> None
-    try:
-        if os.environ['FORMAT'].lower() == 'json':
-            json_object = json.loads(log['message'])
-            if isinstance(json_object, list):
-                # In this case, json_object doesn't have the items() method
-                logger.info(
-                    'Field message is a list and cannot be parsed to JSON')
-                return
-            for key, value in json_object.items():
-                log[key] = value
-    except Exception as e:
-        logger.warning(
-            f'Error occurred while trying to parse log to JSON: {e}. Field will be passed as string.')
-        pass
-
-
-def _parse_cloudwatch_log(log, additional_data):
-    # type: (dict, dict) -> bool
-    _add_timestamp(log)
-    if LAMBDA_LOG_GROUP in additional_data['logGroup']:
-        _extract_lambda_log_message(log)
-    log.update(additional_data)
-    _parse_to_json(log)
-    return True
-
-
-def _get_additional_logs_data(aws_logs_data, context):
-    # type: (dict, 'LambdaContext') -> dict
-    additional_fields = ['logGroup', 'logStream', 'messageType', 'owner']
-    additional_data = dict(
-        (key, aws_logs_data[key]) for key in additional_fields)
-    try:
-        if 'logGroup' in additional_data:
-            namespace = get_service_by_log_group_prefix(
-                additional_data['logGroup'])
-            if namespace == '':
-                logger.info(
-                    f'Mapping from log group to namespace does not exist for log group {additional_data["logGroup"]}')
-            else:
-                additional_data['namespace'] = namespace
+    def _read_member(self, header):
+        # type: (dict) -> bool
+        """Read one member of the payload object, returns True when it starts the logEvents array."""
+        key = self._read_value()
+        if not isinstance(key, str):
+            raise ValueError("Expected a field name in the payload")
+        self._expect(':')
+        if key != 'logEvents':
+            header[key] = self._read_value()
+        elif all(field in header for field in LOGS_DATA_HEADER_FIELDS):
+            self._expect('[')
+            return True
         else:
-            logger.info(
-                'Field logGroup does not appear in data. Field namespace will not be added')
-    except Exception as e:
-        logger.warning(f'Error while trying to get namespace: {e}')
-    try:
-        additional_data['function_version'] = context.function_version
-        additional_data['invoked_function_arn'] = context.invoked_function_arn
-    except KeyError:
-        logger.info(
-            'Failed to find context value. Continue without adding it to the log')
+            # Read event by event, decoding the whole array as one value starts over after every chunk
+            self._expect('[')
+            self._buffered_events = list(self._read_array())
+        return False
+
+    def _read_members(self, header):
+        # type: (dict) -> bool
+        while True:
+            if self._read_member(header):
+                return True
+            if self._expect(',}') == '}':
+                return False
+
+    def read_header(self):
+        # type: () -> dict
+        header = {}
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+        else:
+            self._streaming_events = self._read_members(header)
+        if not self._streaming_events:
+            self._end()
+        self._header = header
+        return header
+
+    def _read_array(self):
+        """Yields the values of the array whose '[' was just read, and reads its ']'."""
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._read_value()
+            if self._expect(',]') == ']':
+                return
 
+    def events(self):
+        """Yields the log events. read_header() must be called first."""
+        if not self._streaming_events:
+            for event in self._buffered_events or []:
+                yield event
+            return
+        for event in self._read_array():
+            yield event
+        # Fields after logEvents are read only to validate the payload
+        if self._expect(',}') == ',':
+            self._read_members(self._header)
+        self._end()
+
+    def _end(self):
+        if self._peek():
+            raise ValueError("Unexpected data after the payload at position {}".format(self._pos))
+
+
+def _json_loads_error(e):
+    logger.error("Got exception while loading json, message: {}".format(e))
+    return ValueError("Exception: json loads")
+
+
+def _decode_events(logs_stream):
+    # type: (AwsLogsDataStream) -> iter
     try:
-        # If ENRICH has value, add the properties
-        if os.environ['ENRICH']:
-            properties_to_enrich = os.environ['ENRICH'].split(";")
-            for property_to_enrich in properties_to_enrich:
-                property_key_value = property_to_enrich.split("=")
-                additional_data[property_key_value[KEY_INDEX]
-                                ] = property_key_value[VALUE_INDEX]
-    except KeyError:
-        pass
+        for log in logs_stream.events():
+            yield log
+    except ValueError as e:
+        raise _json_loads_error(e)
 
+
+def _stream_aws_logs_data(event):
+    # type: (dict) -> (dict, iter)
+    """The payload fields of the event, and an iterator that decodes its log events."""
+    logs_stream = AwsLogsDataStream(event['awslogs']['data'])
     try:
-        additional_data['type'] = os.environ['TYPE']
-    except KeyError:
-        logger.info("Using default TYPE 'logzio_cloudwatch_lambda'.")
-        additional_data['type'] = 'logzio_cloudwatch_lambda'
-    return additional_data
+        aws_logs_data = logs_stream.read_header()
+    except ValueError as e:
+        raise _json_loads_error(e)
+    return aws_logs_data, _decode_events(logs_stream)
+
+
+def _extract_aws_logs_data(event):
+    # type: (dict) -> dict
+    aws_logs_data, log_events = _stream_aws_logs_data(event)
+    aws_logs_data['logEvents'] = list(log_events)
+    return aws_logs_data
+
+
+def _ship_events(shipper, log_events, plan, config):
+    # type: (LogzioShipper, iter, LogStreamPlan, RuntimeConfig) -> int
+    if not config.parallel_workers:
+        return ship_logs(shipper, log_events, plan, config)
+    first_events = list(itertools.islice(log_events, config.parallel_threshold))
+    if len(first_events) < config.parallel_threshold:
+        return ship_logs(shipper, first_events, plan, config)
+    return ship_in_parallel(shipper, itertools.chain(first_events, log_events), ship_logs, (plan, config), config)
 
 
 def lambda_handler(event, context):
     # type (dict, 'LambdaContext') -> None
 
-    logger.debug(f'Handling event: {event}')
-    aws_logs_data = _extract_aws_logs_data(event)
-    logger.debug(f'Logs data: {aws_logs_data}')
-    additional_data = _get_additional_logs_data(aws_logs_data, context)
-    shipper = LogzioShipper()
-
-    logger.info("About to send {} logs".format(
-        len(aws_logs_data['logEvents'])))
-    for log in aws_logs_data['logEvents']:
-        if not isinstance(log, dict):
-            raise TypeError(
-                "Expected log inside logEvents to be a dict but found another type")
-        if _parse_cloudwatch_log(log, additional_data):
-            shipper.add(log)
-
-    shipper.flush()
+    # Formatted only at debug level, the payload can be megabytes
+    logger.debug('Handling event: %s', event)
+    aws_logs_data, log_events = _stream_aws_logs_data(event)
+    logger.debug('Logs data: %s', aws_logs_data)
+    log_events = classify_payload(aws_logs_data, log_events)
+    config = get_config()
+    if log_events is None:
+        spool = get_spool(config.spool_dir, config.spool_max_size)
+        if spool is not None and spool.pending():
+            # Spooled bulks do not wait for the next data payload, they may be evicted by then
+            LogzioShipper(context).flush()
+        else:
+            metrics.report()
+        return
+    plan = plan_cache.get_plan(aws_logs_data, context, config)
+    shipper = LogzioShipper(context)
+    # The first bulk is sent only once the next one is sealed, so a payload that fails to decode
+    # within its first bulk is retried by Lambda without sending any of its logs twice
+    shipper.hold_bulks()
 
+    # Log events are decoded while they are added to bulks
+    try:
+        logs_count = _ship_events(shipper, log_events, plan, config)
+    except Exception:
+        # Bulks already sent in the background are waited for, the held bulk is not sent
+        try:
+            shipper._wait_for_senders()
+        except Exception as e:
+            logger.error("Failed to ship a bulk of the failed payload: {}".format(e))
+        metrics.report()
+        raise
+    logger.info("About to send {} logs".format(logs_count))
 
-def get_service_by_log_group_prefix(log_group):
-    for key in LOG_GROUP_TO_PREFIX:
-        if log_group.startswith(key):
-            return LOG_GROUP_TO_PREFIX[key]
-    return ''
+    shipper.flush()
@@ -5,11 +5,16 @@ import logging
 import os
 import random
 import string
+import tempfile
+import time
 import unittest
 from io import BytesIO
+from unittest import mock
 from logging.config import fileConfig
 import httpretty
 import python3.cloudwatch.src.lambda_function as worker
+import python3.shipper.cloudwatch_logs as cloudwatch_logs
+from python3.shipper.shipper import LogzioShipper
 
 # CONST
 BODY_SIZE = 10
@@ -41,6 +46,13 @@ class TestLambdaFunction(unittest.TestCase):
             del os.environ['FORMAT']
         if os.environ.get('COMPRESS'):
             del os.environ['COMPRESS']
+        os.environ.pop('ENRICH', None)
+        os.environ.pop('LOG_GROUP_PREFIXES', None)
+        os.environ.pop('PARALLEL_WORKERS', None)
+        os.environ.pop('PARALLEL_THRESHOLD', None)
+        os.environ.pop('SPOOL_DIR', None)
+        os.environ.pop('RETRY_MAX_ATTEMPTS', None)
+        os.environ.pop('SENDER_THREADS', None)
 
     def gzipData(self, data):
         zip_text_file = BytesIO()
@@ -186,6 +198,25 @@ class TestLambdaFunction(unittest.TestCase):
         request = httpretty.HTTPretty.last_request
         self._validate_json_data(request, event['dec'], Context)
 
+    @httpretty.activate
+    def test_parallel_parsing(self):
+        os.environ['FORMAT'] = "json"
+        os.environ['PARALLEL_WORKERS'] = "2"
+        os.environ['PARALLEL_THRESHOLD'] = "3"
+        event = self._generate_aws_logs_event(self._json_string_builder)
+        httpretty.register_uri(httpretty.POST, self._logzioUrl, body="first", status=200,
+                               content_type="application/json")
+        worker.lambda_handler(event['enc'], Context)
+        self._validate_json_data(httpretty.HTTPretty.last_request, event['dec'], Context)
+
+        os.environ['COMPRESS'] = "true"
+        worker.lambda_handler(event['enc'], Context)
+        request = httpretty.HTTPretty.last_request
+        self.assertEqual(request.headers['Content-Encoding'], 'gzip')
+        body_logs = gzip.decompress(request.body).splitlines()
+        self.assertEqual(len(body_logs), BODY_SIZE)
+        self.assertEqual([json.loads(log)['id'] for log in body_logs], list(range(BODY_SIZE)))
+
     @httpretty.activate
     def test_large_body(self):
         body_size = 2000
@@ -248,6 +279,293 @@ class TestLambdaFunction(unittest.TestCase):
         with self.assertRaises(IndexError):
             worker.lambda_handler(event['enc'], Context)
 
+    def _handle_and_load_logs(self, event):
+        httpretty.register_uri(httpretty.POST, self._logzioUrl, body="first", status=200,
+                               content_type="application/json")
+        worker.lambda_handler(event, Context)
+        return [json.loads(log) for log in httpretty.HTTPretty.last_request.body.splitlines()]
+
+    @httpretty.activate
+    def test_parsed_fields_override_additional_data(self):
+        os.environ['FORMAT'] = "json"
+        os.environ['ENRICH'] = "foo=bar;environment=testing"
+        messages = [json.dumps({'type': 'from_message', 'foo': 'from_message'}), json.dumps({'key': 'value'})]
+        event = self._generate_aws_logs_event(lambda: messages.pop(0), body_size=2)
+
+        body_logs = self._handle_and_load_logs(event['enc'])
+
+        self.assertEqual(len(body_logs), 2)
+        self.assertEqual(body_logs[0]['type'], 'from_message')
+        self.assertEqual(body_logs[0]['foo'], 'from_message')
+        self.assertEqual(body_logs[1]['type'], os.environ['TYPE'])
+        self.assertEqual(body_logs[1]['foo'], 'bar')
+        self.assertEqual(body_logs[1]['key'], 'value')
+        for body_log in body_logs:
+            self.assertEqual(body_log['environment'], 'testing')
+            self.assertEqual(body_log['logGroup'], 'TestlogGroup')
+            self.assertEqual(body_log['owner'], 'Test')
+
+    @httpretty.activate
+    def test_enrich_overrides_event_fields(self):
+        os.environ['ENRICH'] = "message=enriched"
+        event = self._generate_aws_logs_event(self._random_string_builder)
+
+        body_logs = self._handle_and_load_logs(event['enc'])
+
+        self.assertEqual(len(body_logs), BODY_SIZE)
+        for i, body_log in enumerate(body_logs):
+            self.assertEqual(body_log['message'], 'enriched')
+            self.assertEqual(body_log['id'], i)
+
+    def test_extract_lambda_log_message_formats(self):
+        request_id = 'c9a7d4b6-1c0e-4b8a-9f2e-3d5b7a1e2f40'
+        cases = [
+            ('[INFO]\t2020-02-03T16:26:16.629Z\t{}\tpython message'.format(request_id),
+             {'@timestamp': '2020-02-03T16:26:16.629Z', 'requestID': request_id, 'log_level': 'INFO',
+              'message': 'python message'}),
+            ('2020-02-03T16:26:16.629Z\t{}\tWARN\tnode message'.format(request_id),
+             {'@timestamp': '2020-02-03T16:26:16.629Z', 'requestID': request_id, 'log_level': 'WARN',
+              'message': 'node message'}),
+            ('2023-05-01T10:00:00.123+00:00\t{}\tfail\tdotnet message'.format(request_id),
+             {'@timestamp': '2023-05-01T10:00:00.123+00:00', 'requestID': request_id, 'log_level': 'fail',
+              'message': 'dotnet message'}),
+            ('2020-02-03 16:26:16 {} ERROR Handler - java\nmessage'.format(request_id),
+             {'@timestamp': '2020-02-03 16:26:16', 'requestID': request_id, 'log_level': 'ERROR',
+              'message': 'Handler - java\nmessage'}),
+            ('[ERROR] something failed', {'log_level': 'ERROR', 'message': '[ERROR] something failed'}),
+            ('not a date\t{}\tmessage'.format(request_id), {'message': 'not a date\t{}\tmessage'.format(request_id)}),
+            ('[INFO broken', {'message': '[INFO broken'}),
+            ('START RequestId: {} Version: $LATEST'.format(request_id),
+             {'message': 'START RequestId: {} Version: $LATEST'.format(request_id)}),
+        ]
+        for message, expected in cases:
+            log = {'message': message}
+            cloudwatch_logs.extract_lambda_log_message(log)
+            self.assertEqual(log, expected, message)
+
+    def test_parse_to_json_prefilter(self):
+        os.environ['FORMAT'] = "json"
+        worker.metrics.report()
+        messages = ['plain text line', '  {"k": "v"}', '["a", "list"]', '{not json}', '']
+        logs = [{'message': message} for message in messages]
+        for log in logs:
+            cloudwatch_logs.parse_to_json(log, 'prefilter-log-group')
+
+        self.assertEqual(logs[1], {'message': '  {"k": "v"}', 'k': 'v'})
+        for log, message in zip(logs, messages):
+            if log is not logs[1]:
+                self.assertEqual(log, {'message': message})
+        self.assertEqual(worker.metrics.get('json_parse_skipped'), 3)
+        self.assertEqual(worker.metrics.get('json_parse_failures'), 1)
+
+    def test_json_hit_rate(self):
+        hit_rate = cloudwatch_logs.JsonHitRate()
+        for _ in range(hit_rate.MIN_ATTEMPTS):
+            self.assertTrue(hit_rate.should_parse('text'))
+            hit_rate.record('text', False)
+            hit_rate.record('json', True)
+
+        self.assertTrue(hit_rate.should_parse('json'))
+        self.assertTrue(hit_rate.should_parse('new'))
+        decisions = [hit_rate.should_parse('text') for _ in range(hit_rate.PROBE_INTERVAL)]
+        self.assertEqual(decisions.count(True), 1)
+        self.assertTrue(decisions[-1])
+
+    @staticmethod
+    def _gzip_payload(json_data, members=1):
+        part_size = -(-len(json_data) // members)
+        compressed = b''.join(gzip.compress(json_data[i:i + part_size])
+                              for i in range(0, len(json_data), part_size))
+        return base64.b64encode(compressed)
+
+    def test_stream_aws_logs_data(self):
+        data_body = self._data_body_builder(self._random_string_builder, 50)
+        data_body['logEvents'][3]['message'] = 'caf\u00e9 \u2603 \U0001f600 ' * 20
+        data_body['logEvents'][4]['number'] = 1234567890
+        reordered_body = dict(data_body)
+        log_events = reordered_body.pop('logEvents')
+        reordered_body = dict({'logEvents': log_events}, **reordered_body)
+        for body in [data_body, reordered_body, dict(data_body, logEvents=[])]:
+            json_data = json.dumps(body, indent=1, ensure_ascii=False).encode('utf-8')
+            for members in [1, 3]:
+                for chunk_sizes in [(4, 1), (64, 7), (worker.BASE64_CHUNK_SIZE, worker.DECOMPRESS_CHUNK_SIZE)]:
+                    logs_stream = worker.AwsLogsDataStream(self._gzip_payload(json_data, members), *chunk_sizes)
+                    header = logs_stream.read_header()
+                    events = list(logs_stream.events())
+
+                    self.assertEqual(dict(header, logEvents=events), body)
+
+    def test_stream_aws_logs_data_split_numbers(self):
+        data_body = self._data_body_builder(self._random_string_builder, 2)
+        data_body['x'] = 12.5
+        data_body['logEvents'][0]['number'] = -0.25e-3
+        data_body['logEvents'][1]['number'] = 1E+21
+        json_data = json.dumps(data_body).encode('utf-8')
+        for number in [b'12.5', b'-0.00025', b'1e+21']:
+            start = json_data.index(number)
+            # Every gzip member ends a chunk of decompressed text
+            for split in range(start, start + len(number) + 1):
+                compressed = gzip.compress(json_data[:split]) + gzip.compress(json_data[split:])
+                logs_stream = worker.AwsLogsDataStream(base64.b64encode(compressed))
+                header = logs_stream.read_header()
+                events = list(logs_stream.events())
+
+                self.assertEqual(dict(header, logEvents=events), data_body)
+
+    def test_stream_aws_logs_data_invalid(self):
+        json_data = json.dumps(self._data_body_builder(self._random_string_builder, 5)).encode('utf-8')
+        for invalid_data in [json_data[:-10], json_data + b' {}', json_data.replace(b'}, {', b'} {')]:
+            event = {'awslogs': {'data': self._gzip_payload(invalid_data)}}
+            with self.assertRaises(ValueError):
+                worker._extract_aws_logs_data(event)
+
+        truncated = base64.b64encode(base64.b64decode(self._gzip_payload(json_data))[:-20])
+        with self.assertRaises(ValueError):
+            worker._extract_aws_logs_data({'awslogs': {'data': truncated}})
+
+    @httpretty.activate
+    def test_invalid_payload_sends_nothing(self):
+        httpretty.register_uri(httpretty.POST, self._logzioUrl, status=200, content_type="application/json")
+        data_body = self._data_body_builder(self._random_string_builder, 200)
+        data_body['logEvents'] = data_body.pop('logEvents')
+        # The payload breaks at its last event
+        json_data = json.dumps(data_body).encode('utf-8')
+        event = {'awslogs': {'data': self._gzip_payload(json_data[:-60])}}
+        with self.assertRaises(ValueError):
+            worker.lambda_handler(event, Context)
+        self.assertFalse(httpretty.has_request())
+
+        max_bulk_size = LogzioShipper.MAX_BULK_SIZE_IN_BYTES
+        LogzioShipper.MAX_BULK_SIZE_IN_BYTES = 500
+        try:
+            # After many bulks, only the last sealed bulk is held back when the payload breaks
+            with self.assertRaises(ValueError):
+                worker.lambda_handler(event, Context)
+            sent_logs = [log for request in httpretty.latest_requests() for log in request.body.splitlines()]
+            self.assertTrue(sent_logs)
+            self.assertLess(len(set(sent_logs)), 200)
+        finally:
+            LogzioShipper.MAX_BULK_SIZE_IN_BYTES = max_bulk_size
+
+        worker.lambda_handler({'awslogs': {'data': self._gzip_payload(json_data)}}, Context)
+        self.assertTrue(httpretty.has_request())
+
+    @httpretty.activate
+    def test_invalid_payload_waits_for_senders(self):
+        requests = {'started': 0, 'finished': 0}
+
+        def slow_listener(request, uri, response_headers):
+            requests['started'] += 1
+            time.sleep(0.05)
+            requests['finished'] += 1
+            return [200, response_headers, '']
+
+        httpretty.register_uri(httpretty.POST, self._logzioUrl, body=slow_listener)
+        os.environ['SENDER_THREADS'] = '2'
+        data_body = self._data_body_builder(self._random_string_builder, 200)
+        data_body['logEvents'] = data_body.pop('logEvents')
+        json_data = json.dumps(data_body).encode('utf-8')
+        event = {'awslogs': {'data': self._gzip_payload(json_data[:-60])}}
+        max_bulk_size = LogzioShipper.MAX_BULK_SIZE_IN_BYTES
+        LogzioShipper.MAX_BULK_SIZE_IN_BYTES = 500
+        try:
+            with mock.patch.object(worker.metrics, 'report') as report:
+                with self.assertRaises(ValueError):
+                    worker.lambda_handler(event, Context)
+        finally:
+            LogzioShipper.MAX_BULK_SIZE_IN_BYTES = max_bulk_size
+        # The bulks sent in the background finished before the error was raised
+        self.assertGreater(requests['finished'], 2)
+        self.assertEqual(requests['started'], requests['finished'])
+        report.assert_called_once_with()
+
+    def test_prefix_trie(self):
+        trie = cloudwatch_logs.PrefixTrie([('/aws/', 'aws'), ('/aws/lambda/', 'aws/lambda'), ('/aws/lambda/x', 'x')])
+
+        self.assertEqual(trie.longest_prefix_value('/aws/lambda/function'), 'aws/lambda')
+        self.assertEqual(trie.longest_prefix_value('/aws/lambda/x1'), 'x')
+        self.assertEqual(trie.longest_prefix_value('/aws/ecs/cluster'), 'aws')
+        self.assertEqual(trie.longest_prefix_value('/aw', ''), '')
+        self.assertIsNone(trie.longest_prefix_value('other'))
+
+    def test_user_log_group_prefixes(self):
+        os.environ['LOG_GROUP_PREFIXES'] = "/my/app/=my-app;/aws/lambda/special-=special;broken"
+
+        self.assertEqual(cloudwatch_logs.get_service_by_log_group_prefix('/my/app/service'), 'my-app')
+        self.assertEqual(cloudwatch_logs.get_service_by_log_group_prefix('/aws/lambda/special-function'), 'special')
+        self.assertEqual(cloudwatch_logs.get_service_by_log_group_prefix('/aws/lambda/function'), 'aws/lambda')
+        self.assertEqual(cloudwatch_logs.get_service_by_log_group_prefix('/aws/eks/cluster'), 'aws/eks')
+        self.assertEqual(cloudwatch_logs.get_service_by_log_group_prefix('unknown'), '')
+
+    def test_plan_cache(self):
+        plan_cache = cloudwatch_logs.PlanCache(max_size=2)
+        config = worker.get_config()
+        logs_data = [dict(logGroup='/aws/lambda/f', logStream='stream{}'.format(i), messageType='DATA_MESSAGE',
+                          owner='Test') for i in range(3)]
+        plan = plan_cache.get_plan(logs_data[0], Context, config)
+
+        self.assertIs(plan_cache.get_plan(dict(logs_data[0]), Context, config), plan)
+        self.assertTrue(plan.lambda_log_group)
+        self.assertEqual(plan.additional_data['namespace'], 'aws/lambda')
+        self.assertEqual(plan.additional_data['logStream'], 'stream0')
+        self.assertEqual(plan.additional_data['type'], os.environ['TYPE'])
+        self.assertIsNotNone(plan.template)
+        self.assertIs(plan.template.serializer, config.serializer)
+
+        plan_cache.get_plan(logs_data[1], Context, config)
+        plan_cache.get_plan(logs_data[0], Context, config)
+        plan_cache.get_plan(logs_data[2], Context, config)
+        self.assertIs(plan_cache.get_plan(logs_data[0], Context, config), plan)
+
+        os.environ['ENRICH'] = "message=enriched"
+        enriched_plan = plan_cache.get_plan(logs_data[0], Context, worker.get_config())
+        self.assertIsNot(enriched_plan, plan)
+        self.assertIsNone(enriched_plan.template)
+
+    @httpretty.activate
+    def test_control_message_and_empty_payload_are_not_shipped(self):
+        httpretty.register_uri(httpretty.POST, self._logzioUrl, status=200, content_type="application/json")
+        control_body = self._data_body_builder(self._random_string_builder, 1)
+        control_body['messageType'] = 'CONTROL_MESSAGE'
+        control_body['logEvents'][0]['message'] = 'CWL CONTROL MESSAGE: Checking health of destination Firehose.'
+        empty_body = self._data_body_builder(self._random_string_builder, 0)
+
+        for data_body in [control_body, empty_body]:
+            worker.lambda_handler({'awslogs': {'data': self.gzipData(data_body)}}, Context)
+
+        self.assertEqual(len(httpretty.latest_requests()), 0)
+
+    @httpretty.activate
+    def test_control_message_replays_spool(self):
+        spool_dir = tempfile.mkdtemp()
+        os.environ['SPOOL_DIR'] = spool_dir
+        os.environ['RETRY_MAX_ATTEMPTS'] = '1'
+        httpretty.register_uri(httpretty.POST, self._logzioUrl, status=500)
+        data_body = self._data_body_builder(self._random_string_builder, 2)
+        worker.lambda_handler({'awslogs': {'data': self.gzipData(data_body)}}, Context)
+        self.assertEqual(len(os.listdir(spool_dir)), 1)
+
+        httpretty.reset()
+        httpretty.register_uri(httpretty.POST, self._logzioUrl, status=200, content_type="application/json")
+        control_body = self._data_body_builder(self._random_string_builder, 1)
+        control_body['messageType'] = 'CONTROL_MESSAGE'
+        worker.lambda_handler({'awslogs': {'data': self.gzipData(control_body)}}, Context)
+
+        self.assertEqual(os.listdir(spool_dir), [])
+        self.assertTrue(httpretty.has_request())
+
+    def test_classify_payload(self):
+        worker.metrics.report()
+        control_data = {'messageType': 'CONTROL_MESSAGE'}
+        data = {'messageType': 'DATA_MESSAGE'}
+
+        self.assertIsNone(cloudwatch_logs.classify_payload(control_data, iter([{'message': 'health check'}])))
+        self.assertIsNone(cloudwatch_logs.classify_payload(data, iter([])))
+        self.assertEqual(list(cloudwatch_logs.classify_payload(data, iter([{'id': 1}, {'id': 2}]))),
+                         [{'id': 1}, {'id': 2}])
+        self.assertEqual(worker.metrics.get('control_messages'), 1)
+        self.assertEqual(worker.metrics.get('empty_payloads'), 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,82 @@
+"""Compare the Lambda log line parser with the dateutil based parser it replaced.
+
+Run from the repository root:
+    python -m python3.cloudwatch.tests.parser_benchmark [lines]
+"""
+import random
+import string
+import sys
+import timeit
+
+from dateutil import parser
+
+import python3.shipper.cloudwatch_logs as cloudwatch_logs
+
+REQUEST_ID = 'c9a7d4b6-1c0e-4b8a-9f2e-3d5b7a1e2f40'
+
+
+def legacy_extract_lambda_log_message(log):
+    # type: (dict) -> None
+    str_message = str(log['message'])
+    try:
+        start_level = str_message.index('[')
+        end_level = str_message.index(']')
+        log_level = str_message[start_level + 1:end_level].upper()
+        if log_level in cloudwatch_logs.LOG_LEVELS:
+            log['log_level'] = log_level
+            start_split = end_level + 2
+        else:
+            start_split = 0
+    except ValueError:
+        start_split = 0
+    message_parts = str_message[start_split:].split('\t')
+    size = len(message_parts)
+    if size == cloudwatch_logs.PYTHON_EVENT_SIZE or size == cloudwatch_logs.NODEJS_EVENT_SIZE:
+        try:
+            parser.parse(message_parts[0])
+            log['@timestamp'] = message_parts[0]
+            log['requestID'] = message_parts[1]
+            log['message'] = message_parts[size - 1]
+            if size == cloudwatch_logs.NODEJS_EVENT_SIZE:
+                log['log_level'] = message_parts[2]
+        except Exception:
+            pass
+
+
+def _text():
+    return ' '.join(''.join(random.sample(string.ascii_lowercase, 8)) for _ in range(6))
+
+
+def generate_messages(count):
+    formats = [
+        lambda: '[INFO]\t2020-02-03T16:26:16.629Z\t{}\t{}'.format(REQUEST_ID, _text()),
+        lambda: '2020-02-03T16:26:16.629Z\t{}\tINFO\t{}'.format(REQUEST_ID, _text()),
+        lambda: '2020-02-03T16:26:16.629Z\t{}\tinfo\t{}'.format(REQUEST_ID, _text()),
+        lambda: 'END RequestId: {}'.format(REQUEST_ID),
+        lambda: _text(),
+    ]
+    return [random.choice(formats)() for _ in range(count)]
+
+
+def run(parse, messages):
+    for message in messages:
+        parse({'message': message})
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    messages = generate_messages(count)
+    for message in messages:
+        legacy_log, log = {'message': message}, {'message': message}
+        legacy_extract_lambda_log_message(legacy_log)
+        cloudwatch_logs.extract_lambda_log_message(log)
+        assert log == legacy_log, message
+
+    legacy_seconds = min(timeit.repeat(lambda: run(legacy_extract_lambda_log_message, messages), number=1, repeat=3))
+    seconds = min(timeit.repeat(lambda: run(cloudwatch_logs.extract_lambda_log_message, messages), number=1, repeat=3))
+    print('{} lines: dateutil parser {:.1f} ms, compiled parser {:.1f} ms, {:.1f}x faster'.format(
+        count, legacy_seconds * 1000, seconds * 1000, legacy_seconds / seconds))
+
+
+if __name__ == '__main__':
+    main()
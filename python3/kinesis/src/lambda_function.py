@@ -1,70 +1,147 @@
 import base64
+import collections
 import datetime as dt
 import json
 import logging
 import os
-import copy
 import gzip
-import binascii
+import time
 
+from python3.shipper import cloudwatch_logs, kpl
+from python3.shipper.config import get_config
+from python3.shipper.metrics import metrics
+from python3.shipper.parallel import ship_in_parallel
+from python3.shipper.serializer import SharedFieldsTemplate
 from python3.shipper.shipper import LogzioShipper
 
 # set logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-MESSAGES_ARRAY_ENV = 'MESSAGES_ARRAY'
 
 
-def _extract_record_data(data):
-    # type: (str) -> str
-    # The decoded string is returned. A TypeError is raised if s is
+GZIP_MAGIC = b'\x1f\x8b'
+DEFAULT_TYPE = "kinesis_lambda"
+# CloudWatch Logs subscriptions write their payloads to Kinesis as compact JSON, starting with this field
+CLOUDWATCH_LOGS_PREFIX = b'{"messageType":'
+# Tells _get_type that the data was not parsed yet, since None is the parsed null
+_NOT_PARSED = object()
+
+
+# The fields of the Lambda context that logs from CloudWatch Logs get, which worker processes can receive
+ContextFields = collections.namedtuple('ContextFields', ['function_version', 'invoked_function_arn'])
+
+
+class DecodeTimings(object):
+    """Seconds spent in each stage of decoding the data of records, added to the metrics once per batch."""
+    STAGES = ('base64', 'gunzip', 'json', 'utf8')
+
+    def __init__(self):
+        self.seconds = dict((stage, 0.0) for stage in self.STAGES)
+
+    def add(self, stage, start_time):
+        # type: (str, float) -> float
+        now = time.perf_counter()
+        self.seconds[stage] += now - start_time
+        return now
+
+    def report(self):
+        for stage, seconds in self.seconds.items():
+            if seconds:
+                metrics.increment('decode_{}_seconds'.format(stage), round(seconds, 6))
+
+
+def _extract_record_data(data, timings=None):
+    # type: (str, DecodeTimings) -> bytes
+    # The decoded bytes are returned. A binascii.Error is raised if data is
     # incorrectly padded
+    timings = timings or DecodeTimings()
+    start_time = time.perf_counter()
     try:
-        # decompress the payload if it looks gzippy
         decoded = base64.b64decode(data)
-        if binascii.hexlify(decoded[0:2]) == b'1f8b':
-            return gzip.decompress(decoded)
-        else:
-            return decoded
-    except TypeError as e:
+    except (TypeError, ValueError) as e:
         logger.error("Fail to decode record data: {}".format(str(e)))
         raise
+    timings.add('base64', start_time)
+    return _gunzip(decoded, timings)
 
 
-def _parse_json(log, record_data):
-    # type: (dict, str) -> None
-    log.update(json.loads(record_data))
+def _gunzip(data, timings):
+    # type: (bytes | memoryview, DecodeTimings) -> bytes | memoryview
+    # decompress the payload if it looks gzippy
+    if data[:2] != GZIP_MAGIC:
+        return data
+    start_time = time.perf_counter()
+    data = gzip.decompress(data)
+    timings.add('gunzip', start_time)
+    return data
 
 
-def _get_type(data):
-    # type: (str) -> str
+def _parse_record_data(record_data, config, timings):
+    # type: (bytes | memoryview, RuntimeConfig, DecodeTimings) -> object
+    """The record data parsed as JSON, or None if it is not valid JSON."""
+    start_time = time.perf_counter()
     try:
-        return os.environ['TYPE']
-    except KeyError:
-        pass
+        try:
+            return config.serializer.loads(record_data)
+        except TypeError:
+            # The json module does not parse memoryviews of user records
+            return config.serializer.loads(bytes(record_data))
+    except (ValueError, RecursionError):
+        return None
+    finally:
+        timings.add('json', start_time)
 
+
+def _decode_text(record_data, timings):
+    # type: (bytes | memoryview, DecodeTimings) -> str
+    start_time = time.perf_counter()
+    try:
+        return str(record_data, 'utf-8')
+    except UnicodeDecodeError:
+        logger.warning("Record data is not valid UTF-8, replacing the invalid bytes")
+        metrics.increment('invalid_utf8_records')
+        return str(record_data, 'utf-8', 'replace')
+    finally:
+        timings.add('utf8', start_time)
+
+
+def _get_type(data, config=None, json_data=_NOT_PARSED):
+    # type: (str, RuntimeConfig, object) -> str
+    log_type = (config or get_config()).log_type
+    if log_type is not None:
+        return log_type
+
+    if json_data is _NOT_PARSED:
+        try:
+            json_data = json.loads(data)
+        except ValueError:
+            return DEFAULT_TYPE
     try:
-        json_data = json.loads(data)
         return json_data["source"].split('.')[1]
-    except (KeyError, ValueError):
-        return "kinesis_lambda"
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return DEFAULT_TYPE
 
 
-def _add_record_kinesis_fields(log, record_kinesis_field):
-    # type: (dict, dict) -> None
+def _add_record_kinesis_fields(log, record_kinesis_field, config=None, timings=None, record_data=None,
+                               json_data=_NOT_PARSED):
+    # type: (dict, dict, RuntimeConfig, DecodeTimings, bytes | memoryview, object) -> None
+    config = config or get_config()
+    timings = timings or DecodeTimings()
     for key, value in record_kinesis_field.items():
         if key == "data":
-            record_data = _extract_record_data(value)
+            if record_data is None:
+                record_data = _extract_record_data(value, timings)
+            # The data is parsed at most once, for FORMAT json and for detecting the type
+            if json_data is _NOT_PARSED:
+                json_data = None
+                if config.format_json or config.log_type is None:
+                    json_data = _parse_record_data(record_data, config, timings)
             # If FORMAT is json treat message as a json
-            try:
-                if os.environ["FORMAT"].lower() == "json":
-                    _parse_json(log, record_data)
-                else:
-                    log["message"] = record_data
-            except (KeyError, ValueError):
-                # Put data as a string
-                log["message"] = record_data
-            log["type"] = _get_type(record_data)
+            if config.format_json and isinstance(json_data, dict):
+                log.update(json_data)
+            else:
+                log["message"] = _decode_text(record_data, timings)
+            log["type"] = _get_type(record_data, config, json_data)
         elif key == "approximateArrivalTimestamp":
             try:
                 log["@timestamp"] = dt.datetime.utcfromtimestamp(
@@ -77,51 +154,152 @@ def _add_record_kinesis_fields(log, record_kinesis_field):
             log[key] = value
 
 
-def _parse_kinesis_record(record):
-    # type: (dict, str) -> dict
+def _parse_kinesis_record(record, config=None, timings=None, record_data=None, json_data=_NOT_PARSED):
+    # type: (dict, RuntimeConfig, DecodeTimings, bytes | memoryview, object) -> dict
     log = {}
     for record_key, record_value in record.items():
         if record_key == "kinesis":
-            _add_record_kinesis_fields(log, record_value)
+            _add_record_kinesis_fields(log, record_value, config, timings, record_data, json_data)
         else:
             log[record_key] = record_value
     return log
 
 
-def split_by_fields(log, field):
-    logs = []
+def _parse_kinesis_records(record, config, timings, record_data, json_data=_NOT_PARSED):
+    # type: (dict, RuntimeConfig, DecodeTimings, bytes | None, object) -> iter
+    """Yields the log of a record, or the log of every user record in it when the KPL aggregated it.
+
+    json_data is the record data already parsed as JSON, if it was.
+    """
+    if record_data is None or not kpl.is_aggregated(record_data):
+        yield _parse_kinesis_record(record, config, timings, record_data, json_data)
+        return
+    try:
+        # Decoded before any log is yielded, so a malformed user record fails the whole record alike
+        user_records = list(kpl.deaggregate(record_data))
+    except kpl.AggregationError as e:
+        logger.warning("Shipping aggregated record as a single log: {}".format(e))
+        metrics.increment('kpl_invalid_records')
+        yield _parse_kinesis_record(record, config, timings, record_data)
+        return
+    metrics.increment('kpl_aggregated_records')
+    for user_record in user_records:
+        log = _parse_kinesis_record(record, config, timings, _gunzip(user_record.data, timings))
+        log["partitionKey"] = user_record.partition_key
+        if user_record.explicit_hash_key is not None:
+            log["explicitHashKey"] = user_record.explicit_hash_key
+        log["subSequenceNumber"] = user_record.sub_sequence_number
+        yield log
+
+
+def split_by_fields(log, field, serializer=None):
+    # type: (dict, str, object) -> iter
+    """Yields a log for every element of log[field], with the rest of the fields of log.
+
+    The rest of the fields are shared by the logs instead of copied, so they must
+    not be changed. With a serializer they are encoded only once, and the logs
+    are yielded serialized, except for elements that have one of their keys.
+    """
+    shared_fields = dict((key, value) for key, value in log.items() if key != field)
+    template = SharedFieldsTemplate(shared_fields, serializer) if serializer is not None else None
     for msg in log[field]:
-        temp_log = copy.deepcopy(log)
-        temp_log.update(msg)
-        temp_log.pop(field)
-        logs.append(temp_log)
-    return logs
+        if template is not None and isinstance(msg, dict) and field not in msg and template.keys.isdisjoint(msg):
+            yield template.dumps(msg)
+            continue
+        split_log = dict(shared_fields)
+        split_log.update(msg)
+        split_log.pop(field, None)
+        yield split_log
+
+
+def _sequence_number(record):
+    # type: (dict) -> str
+    return record["kinesis"]["sequenceNumber"]
+
+
+def _parse_cloudwatch_logs_data(record_data, config, timings):
+    # type: (bytes | None, RuntimeConfig, DecodeTimings) -> (dict | None, object)
+    """The CloudWatch Logs subscription payload in the record data, or None if it does not hold one.
+
+    Also returns the record data parsed as JSON, or _NOT_PARSED when it does
+    not look like a payload, so that a record is never parsed twice.
+    """
+    if record_data is None or record_data[:len(CLOUDWATCH_LOGS_PREFIX)] != CLOUDWATCH_LOGS_PREFIX:
+        return None, _NOT_PARSED
+    json_data = _parse_record_data(record_data, config, timings)
+    if not isinstance(json_data, dict) or not isinstance(json_data.get('logEvents'), list) or \
+            any(field not in json_data for field in cloudwatch_logs.LOGS_DATA_HEADER_FIELDS):
+        return None, json_data
+    return json_data, json_data
+
+
+def _ship_cloudwatch_logs(shipper, aws_logs_data, config, context):
+    # type: (LogzioShipper, dict, RuntimeConfig, ContextFields) -> int
+    """Ship the log events of a CloudWatch Logs payload as the CloudWatch handler does."""
+    log_events = cloudwatch_logs.classify_payload(aws_logs_data, iter(aws_logs_data.pop('logEvents')))
+    if log_events is None:
+        return 0
+    plan = cloudwatch_logs.plan_cache.get_plan(aws_logs_data, context, config)
+    return cloudwatch_logs.ship_logs(shipper, log_events, plan, config)
+
+
+def _context_fields(context):
+    # type: ('LambdaContext') -> ContextFields | None
+    if context is None:
+        return None
+    return ContextFields(getattr(context, 'function_version', None), getattr(context, 'invoked_function_arn', None))
+
+
+def _ship_records(shipper, records, config, context=None):
+    # type: (LogzioShipper, list, RuntimeConfig, ContextFields) -> None
+    multiple_msgs = config.messages_array
+    timings = DecodeTimings()
+    for record in records:
+        if config.report_batch_item_failures:
+            shipper.set_tags((_sequence_number(record),))
+        data = record.get("kinesis", {}).get("data")
+        record_data = _extract_record_data(data, timings) if data is not None else None
+        aws_logs_data, json_data = _parse_cloudwatch_logs_data(record_data, config, timings)
+        if aws_logs_data is not None:
+            # Every log event becomes a log of its own, instead of the whole payload being one message
+            _ship_cloudwatch_logs(shipper, aws_logs_data, config, context)
+            continue
+        for log in _parse_kinesis_records(record, config, timings, record_data, json_data):
+            if multiple_msgs and multiple_msgs in log:
+                shipper.add_many(split_by_fields(log, multiple_msgs, config.serializer))
+            else:
+                shipper.add(log)
+    timings.report()
+
+
+def _batch_item_failures(records, failed_sequence_numbers):
+    # type: (list, set) -> dict
+    failures = [{"itemIdentifier": _sequence_number(record)} for record in records
+                if _sequence_number(record) in failed_sequence_numbers]
+    if failures:
+        logger.warning("Reporting {} of {} records as failed, Lambda will retry them".format(
+            len(failures), len(records)))
+    return {"batchItemFailures": failures}
 
 
 def lambda_handler(event, context):
-    # type: (dict, 'LambdaContext') -> None
+    # type: (dict, 'LambdaContext') -> dict | None
     logger.info("Received {} raw Kinesis records.".format(
         len(event["Records"])))
-    multiple_msgs = os.environ.get(MESSAGES_ARRAY_ENV)
-
     if not os.environ.get('COMPRESS'):
         os.environ['COMPRESS'] = str(True)
 
-    shipper = LogzioShipper()
-    for record in event['Records']:
-        log = _parse_kinesis_record(record)
-        if multiple_msgs and multiple_msgs in log:
-            logs = split_by_fields(log, multiple_msgs)
-        else:
-            try:
-                log["message"] = log["message"].decode("utf-8")
-            except UnicodeDecodeError:
-                data = gzip.decompress(log["message"])
-                log["message"] = data.decode('utf-8')
-            except (AttributeError, KeyError):
-                pass
-            logs = [log]
-        for log in logs:
-            shipper.add(log)
+    config = get_config()
+    # With REPORT_BATCH_ITEM_FAILURES, bulks that fail to ship fail only the records they hold
+    shipper = LogzioShipper(context, track_failures=config.report_batch_item_failures)
+    records = event['Records']
+    context_fields = _context_fields(context)
+    if config.parallel_workers and len(records) >= config.parallel_threshold:
+        # Workers tag the logs of every record with its sequence number, as _ship_records does here
+        ship_in_parallel(shipper, records, _ship_records, (config, context_fields), config)
+    else:
+        _ship_records(shipper, records, config, context_fields)
 
     shipper.flush()
+    if config.report_batch_item_failures:
+        return _batch_item_failures(records, shipper.failed_tags)
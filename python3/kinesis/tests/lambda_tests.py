@@ -1,6 +1,7 @@
 import base64
 import copy
 import gzip
+import hashlib
 import json
 import logging
 import os
@@ -13,6 +14,12 @@ from logging.config import fileConfig
 import httpretty
 
 import python3.kinesis.src.lambda_function as worker
+from python3.shipper.shipper import LogzioShipper, MaxRetriesException
+from python3.shipper import kpl
+from python3.shipper.config import get_config
+from python3.shipper.metrics import metrics
+from python3.shipper.parallel import LinesCollector
+from python3.shipper.serializer import StdlibSerializer
 
 # CONST
 RECORD_SIZE = 10
@@ -35,6 +42,38 @@ _kinesis_data = {
     'approximateArrivalTimestamp': 1539783387.44,
 }
 
+
+def _varint(value):
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append(value & 0x7f | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _protobuf_field(number, wire_type, value):
+    key = _varint(number << 3 | wire_type)
+    if wire_type == kpl.VARINT:
+        return key + _varint(value)
+    return key + _varint(len(value)) + value
+
+
+def _aggregate(user_records, explicit_hash_key=None):
+    # Builds a KPL aggregated record of (partition key, data) user records
+    partition_keys = sorted(set(partition_key for partition_key, _ in user_records))
+    message = b''.join(_protobuf_field(1, kpl.LENGTH_DELIMITED, key.encode('utf-8')) for key in partition_keys)
+    if explicit_hash_key is not None:
+        message += _protobuf_field(2, kpl.LENGTH_DELIMITED, explicit_hash_key.encode('utf-8'))
+    for partition_key, data in user_records:
+        record = _protobuf_field(1, kpl.VARINT, partition_keys.index(partition_key))
+        if explicit_hash_key is not None:
+            record += _protobuf_field(2, kpl.VARINT, 0)
+        record += _protobuf_field(3, kpl.LENGTH_DELIMITED, data)
+        message += _protobuf_field(3, kpl.LENGTH_DELIMITED, record)
+    return kpl.KPL_MAGIC + message + hashlib.md5(message).digest()
+
+
 fileConfig('logging_config.ini')
 logger = logging.getLogger(__name__)
 
@@ -54,6 +93,9 @@ class TestLambdaFunction(unittest.TestCase):
             del os.environ['FORMAT']
         if os.environ.get('COMPRESS'):
             del os.environ['COMPRESS']
+        for env in ['RETRY_MAX_ATTEMPTS', 'REPORT_BATCH_ITEM_FAILURES', 'MESSAGES_ARRAY', 'PARALLEL_WORKERS',
+                    'PARALLEL_THRESHOLD']:
+            os.environ.pop(env, None)
 
     @staticmethod
     # Build random string with STRING_LEN chars
@@ -131,8 +173,29 @@ class TestLambdaFunction(unittest.TestCase):
                     print(key)
                     self.fail("Failed to find key in the original event")
 
+    def _sequenced_event(self, messages):
+        records = []
+        for i, message in enumerate(messages):
+            record = self._kinesis_record_builder(lambda: message)
+            record['kinesis']['sequenceNumber'] = str(1000 + i)
+            records.append(record)
+        return {'Records': records}
+
+    def _register_failing_listener(self, marker):
+        # Stands in for the listener, failing every bulk that holds the marker
+        bulks = []
+
+        def request_callback(request, uri, response_headers):
+            bulks.append(request.body)
+            return [500 if marker in request.body else 200, response_headers, "ok"]
+
+        httpretty.register_uri(httpretty.POST, self._logzioUrl, body=request_callback)
+        return bulks
+
     @httpretty.activate
     def test_json_type_request(self):
+        # The handler compresses when COMPRESS is not set, and this test reads a plain body
+        os.environ['COMPRESS'] = "false"
         os.environ['FORMAT'] = "JSON"
         event = self._generate_kinesis_event(self._json_string_builder, RECORD_SIZE)
         httpretty.register_uri(httpretty.POST, self._logzioUrl, body="first", status=200,
@@ -147,6 +210,8 @@ class TestLambdaFunction(unittest.TestCase):
 
     @httpretty.activate
     def test_msgs_array(self):
+        # The handler compresses when COMPRESS is not set, and this test reads a plain body
+        os.environ['COMPRESS'] = "false"
         os.environ['MESSAGES_ARRAY'] = "messages"
         os.environ['FORMAT'] = "JSON"
         event = self._generate_kinesis_event(self._json_multiple_messages_builder, 1)
@@ -172,6 +237,271 @@ class TestLambdaFunction(unittest.TestCase):
             if key != "level" and key != "info":
                 self.assertEqual(first_msg[key], second_msg[key])
 
+    def test_decode_record_data(self):
+        class CountingSerializer(StdlibSerializer):
+            parsed = 0
+
+            def loads(self, data):
+                CountingSerializer.parsed += 1
+                return super(CountingSerializer, self).loads(data)
+
+        os.environ.pop('TYPE')
+        os.environ['FORMAT'] = "json"
+        config = get_config()._replace(serializer=CountingSerializer())
+        timings = worker.DecodeTimings()
+        gzipped = base64.b64encode(gzip.compress(json.dumps({'source': 'aws.ec2', 'field1': 'abcd'}).encode('utf-8')))
+
+        log = {}
+        worker._add_record_kinesis_fields(log, {'data': gzipped}, config, timings)
+        self.assertEqual(log, {'source': 'aws.ec2', 'field1': 'abcd', 'type': 'ec2'})
+        self.assertEqual(CountingSerializer.parsed, 1)
+        self.assertGreater(timings.seconds['gunzip'], 0)
+
+        log = {}
+        worker._add_record_kinesis_fields(log, {'data': base64.b64encode(b'plain \xff text')}, config, timings)
+        self.assertEqual(log, {'message': 'plain \ufffd text', 'type': 'kinesis_lambda'})
+        self.assertEqual(CountingSerializer.parsed, 2)
+
+        os.environ['TYPE'] = "logzio_kinesis"
+        config = get_config()._replace(serializer=CountingSerializer(), format_json=False)
+        log = {}
+        worker._add_record_kinesis_fields(log, {'data': base64.b64encode(b'{"source": "aws.ec2"}')}, config, timings)
+        self.assertEqual(log, {'message': '{"source": "aws.ec2"}', 'type': 'logzio_kinesis'})
+        self.assertEqual(CountingSerializer.parsed, 2)
+
+        metrics.take_counters()
+        timings.report()
+        reported = metrics.snapshot()
+        for stage in worker.DecodeTimings.STAGES:
+            self.assertIn('decode_{}_seconds'.format(stage), reported)
+        metrics.take_counters()
+
+    @httpretty.activate
+    def test_batch_item_failures(self):
+        os.environ['COMPRESS'] = "false"
+        os.environ['RETRY_MAX_ATTEMPTS'] = "1"
+        os.environ['REPORT_BATCH_ITEM_FAILURES'] = "true"
+        messages = ['message {}'.format(i) for i in range(10)]
+        messages[5] = 'failing message'
+        event = self._sequenced_event(messages)
+        bulks = self._register_failing_listener(b'failing')
+        log_size = len(json.dumps(worker._parse_kinesis_record(event['Records'][0])))
+        max_bulk_size = LogzioShipper.MAX_BULK_SIZE_IN_BYTES
+        # Two logs in every bulk
+        LogzioShipper.MAX_BULK_SIZE_IN_BYTES = int(log_size * 2.5)
+        try:
+            result = worker.lambda_handler(event, None)
+        finally:
+            LogzioShipper.MAX_BULK_SIZE_IN_BYTES = max_bulk_size
+
+        self.assertEqual(len(bulks), 5)
+        self.assertEqual(result, {'batchItemFailures': [{'itemIdentifier': '1004'}, {'itemIdentifier': '1005'}]})
+        shipped = [json.loads(log)['message'] for bulk in bulks if b'failing' not in bulk for log in bulk.splitlines()]
+        self.assertEqual(shipped, [message for i, message in enumerate(messages) if i not in (4, 5)])
+
+        httpretty.reset()
+        self._register_failing_listener(b'none of them')
+        self.assertEqual(worker.lambda_handler(event, None), {'batchItemFailures': []})
+
+    @httpretty.activate
+    def test_batch_item_failures_in_parallel(self):
+        os.environ['COMPRESS'] = "false"
+        os.environ['RETRY_MAX_ATTEMPTS'] = "1"
+        os.environ['REPORT_BATCH_ITEM_FAILURES'] = "true"
+        os.environ['PARALLEL_WORKERS'] = "2"
+        os.environ['PARALLEL_THRESHOLD'] = "1"
+        messages = ['message {}'.format(i) for i in range(10)]
+        messages[5] = 'failing message'
+        event = self._sequenced_event(messages)
+        bulks = self._register_failing_listener(b'failing')
+        log_size = len(json.dumps(worker._parse_kinesis_record(event['Records'][0])))
+        max_bulk_size = LogzioShipper.MAX_BULK_SIZE_IN_BYTES
+        LogzioShipper.MAX_BULK_SIZE_IN_BYTES = int(log_size * 2.5)
+        try:
+            result = worker.lambda_handler(event, None)
+        finally:
+            LogzioShipper.MAX_BULK_SIZE_IN_BYTES = max_bulk_size
+
+        # Only the records of the failed bulk, not every record of the chunk the worker parsed
+        self.assertEqual(len(bulks), 5)
+        self.assertEqual(result, {'batchItemFailures': [{'itemIdentifier': '1004'}, {'itemIdentifier': '1005'}]})
+        metrics.take_counters()
+
+    @httpretty.activate
+    def test_failed_bulk_fails_batch_by_default(self):
+        os.environ['COMPRESS'] = "false"
+        os.environ['RETRY_MAX_ATTEMPTS'] = "1"
+        event = self._sequenced_event(['failing message'])
+        self._register_failing_listener(b'failing')
+        with self.assertRaises(MaxRetriesException):
+            worker.lambda_handler(event, None)
+
+    def test_deaggregate(self):
+        user_records = [('key-{}'.format(i % 3), 'user record {}'.format(i).encode('utf-8')) for i in range(200)]
+        aggregated = _aggregate(user_records, explicit_hash_key='1234')
+        deaggregated = list(kpl.deaggregate(aggregated))
+        self.assertEqual(len(deaggregated), 200)
+        for i, user_record in enumerate(deaggregated):
+            self.assertIsInstance(user_record.data, memoryview)
+            self.assertEqual(user_record.sub_sequence_number, i)
+            self.assertEqual((user_record.partition_key, bytes(user_record.data)), user_records[i])
+            self.assertEqual(user_record.explicit_hash_key, '1234')
+
+        self.assertFalse(kpl.is_aggregated(b'{"message": "not aggregated"}'))
+        corrupted = bytearray(aggregated)
+        corrupted[10] ^= 0xff
+        with self.assertRaises(kpl.AggregationError):
+            kpl.deaggregate(bytes(corrupted))
+
+    @httpretty.activate
+    def test_aggregated_record(self):
+        os.environ['COMPRESS'] = "false"
+        os.environ['FORMAT'] = "json"
+        user_records = [('first', json.dumps({'field1': 'abcd'}).encode('utf-8')),
+                        ('second', b'plain text'),
+                        ('first', gzip.compress(json.dumps({'field2': 'efgh'}).encode('utf-8')))]
+        record = self._kinesis_record_builder(self._random_string_builder)
+        record['kinesis']['data'] = base64.b64encode(_aggregate(user_records))
+        corrupted_record = copy.deepcopy(record)
+        corrupted_record['kinesis']['data'] = base64.b64encode(_aggregate(user_records)[:-1] + b'\x00')
+        httpretty.register_uri(httpretty.POST, self._logzioUrl, body="first", status=200,
+                               content_type="application/json")
+
+        worker.lambda_handler({'Records': [record]}, None)
+        body_logs = [json.loads(log) for log in httpretty.HTTPretty.last_request.body.splitlines()]
+        self.assertEqual(len(body_logs), 3)
+        self.assertEqual([log['partitionKey'] for log in body_logs], ['first', 'second', 'first'])
+        self.assertEqual([log['subSequenceNumber'] for log in body_logs], [0, 1, 2])
+        self.assertEqual(body_logs[0]['field1'], 'abcd')
+        self.assertEqual(body_logs[1]['message'], 'plain text')
+        self.assertEqual(body_logs[2]['field2'], 'efgh')
+        for log in body_logs:
+            self.assertEqual(log['sequenceNumber'], _kinesis_data['sequenceNumber'])
+            self.assertEqual(log['type'], os.environ['TYPE'])
+
+        worker.lambda_handler({'Records': [corrupted_record]}, None)
+        body_logs = httpretty.HTTPretty.last_request.body.splitlines()
+        self.assertEqual(len(body_logs), 1)
+        self.assertEqual(json.loads(body_logs[0])['partitionKey'], _kinesis_data['partitionKey'])
+
+    @staticmethod
+    def _cloudwatch_logs_data(message_type, messages):
+        # Serialized as CloudWatch Logs writes it to Kinesis, compact and gzip compressed
+        return gzip.compress(json.dumps({
+            'messageType': message_type,
+            'owner': '123456789012',
+            'logGroup': '/aws/lambda/TestFunction',
+            'logStream': '2020/02/03/[$LATEST]abcd',
+            'subscriptionFilters': ['kinesis'],
+            'logEvents': [{'id': str(i), 'timestamp': 1580747176629, 'message': message}
+                          for i, message in enumerate(messages)]
+        }, separators=(',', ':')).encode('utf-8'))
+
+    @httpretty.activate
+    def test_cloudwatch_logs_record(self):
+        os.environ['COMPRESS'] = "false"
+        request_id = 'c9a7d4b6-1c0e-4b8a-9f2e-3d5b7a1e2f40'
+        messages = ['[INFO]\t2020-02-03T16:26:16.629Z\t{}\tfirst message\n'.format(request_id),
+                    '[WARNING]\t2020-02-03T16:26:17.629Z\t{}\tsecond message\n'.format(request_id),
+                    'END RequestId: {}\n'.format(request_id)]
+        record = self._kinesis_record_builder(self._random_string_builder)
+        record['kinesis']['data'] = base64.b64encode(self._cloudwatch_logs_data('DATA_MESSAGE', messages))
+        plain_record = self._kinesis_record_builder(self._random_string_builder)
+        httpretty.register_uri(httpretty.POST, self._logzioUrl, body="first", status=200,
+                               content_type="application/json")
+
+        worker.lambda_handler({'Records': [record, plain_record]}, None)
+        body_logs = [json.loads(log) for log in httpretty.HTTPretty.last_request.body.splitlines()]
+        self.assertEqual(len(body_logs), 4)
+        self.assertEqual([log.get('log_level') for log in body_logs[:3]], ['INFO', 'WARNING', None])
+        self.assertEqual([log['message'] for log in body_logs[:2]], ['first message\n', 'second message\n'])
+        for log in body_logs[:3]:
+            self.assertEqual(log['logGroup'], '/aws/lambda/TestFunction')
+            self.assertEqual(log['namespace'], 'aws/lambda')
+            self.assertEqual(log['type'], os.environ['TYPE'])
+            self.assertNotIn('sequenceNumber', log)
+        self.assertEqual(body_logs[0]['requestID'], request_id)
+        self.assertEqual(body_logs[3]['sequenceNumber'], _kinesis_data['sequenceNumber'])
+
+    @httpretty.activate
+    def test_cloudwatch_logs_control_message(self):
+        record = self._kinesis_record_builder(self._random_string_builder)
+        record['kinesis']['data'] = base64.b64encode(
+            self._cloudwatch_logs_data('CONTROL_MESSAGE', ['CWL CONTROL MESSAGE: Checking health of destination']))
+        httpretty.register_uri(httpretty.POST, self._logzioUrl, body="first", status=200,
+                               content_type="application/json")
+
+        worker.lambda_handler({'Records': [record]}, None)
+        self.assertFalse(httpretty.HTTPretty.latest_requests)
+
+        # Records that only look like a payload are shipped as they are
+        aws_logs_data, json_data = worker._parse_cloudwatch_logs_data(b'{"messageType":"DATA_MESSAGE","logEvents":[]}',
+                                                                      get_config(), worker.DecodeTimings())
+        self.assertIsNone(aws_logs_data)
+        self.assertEqual(json_data, {'messageType': 'DATA_MESSAGE', 'logEvents': []})
+
+    def test_cloudwatch_logs_lookalike_parsed_once(self):
+        class CountingSerializer(StdlibSerializer):
+            parsed = 0
+
+            def loads(self, data):
+                CountingSerializer.parsed += 1
+                return super(CountingSerializer, self).loads(data)
+
+        os.environ['FORMAT'] = "json"
+        config = get_config()._replace(serializer=CountingSerializer())
+        record = self._kinesis_record_builder(self._random_string_builder)
+        record['kinesis']['data'] = base64.b64encode(b'{"messageType":"DATA_MESSAGE","logEvents":[]}')
+        collector = LinesCollector(config.serializer)
+
+        worker._ship_records(collector, [record], config)
+        self.assertEqual(CountingSerializer.parsed, 1)
+        self.assertEqual(len(collector.lines), 1)
+        self.assertEqual(json.loads(collector.lines[0])['messageType'], 'DATA_MESSAGE')
+
+    @httpretty.activate
+    def test_aggregated_record_with_malformed_user_record(self):
+        os.environ['COMPRESS'] = "false"
+        # The digest is valid, but the second user record has no data
+        message = _protobuf_field(1, kpl.LENGTH_DELIMITED, b'first') + \
+            _protobuf_field(3, kpl.LENGTH_DELIMITED, _protobuf_field(1, kpl.VARINT, 0) +
+                            _protobuf_field(3, kpl.LENGTH_DELIMITED, b'user record')) + \
+            _protobuf_field(3, kpl.LENGTH_DELIMITED, _protobuf_field(1, kpl.VARINT, 0))
+        aggregated = kpl.KPL_MAGIC + message + hashlib.md5(message).digest()
+        with self.assertRaises(kpl.AggregationError):
+            list(kpl.deaggregate(aggregated))
+
+        record = self._kinesis_record_builder(self._random_string_builder)
+        record['kinesis']['data'] = base64.b64encode(aggregated)
+        httpretty.register_uri(httpretty.POST, self._logzioUrl, body="first", status=200,
+                               content_type="application/json")
+        worker.lambda_handler({'Records': [record]}, None)
+
+        # Shipped as a single log, like an aggregated record that fails its digest
+        body_logs = httpretty.HTTPretty.last_request.body.splitlines()
+        self.assertEqual(len(body_logs), 1)
+        self.assertEqual(json.loads(body_logs[0])['partitionKey'], _kinesis_data['partitionKey'])
+
+    def test_split_by_fields(self):
+        log = {'field1': 'id', 'nested': {'host': 'a'}, 'messages': [
+            {'info': 'first message'},
+            {'info': 'second message', 'field1': 'overridden'},
+            {'info': 'third message', 'messages': 'dropped'},
+        ]}
+        expected = [
+            {'field1': 'id', 'nested': {'host': 'a'}, 'info': 'first message'},
+            {'field1': 'overridden', 'nested': {'host': 'a'}, 'info': 'second message'},
+            {'field1': 'id', 'nested': {'host': 'a'}, 'info': 'third message'},
+        ]
+        self.assertEqual(list(worker.split_by_fields(log, 'messages')), expected)
+        self.assertEqual(len(log['messages']), 3)
+
+        serialized = list(worker.split_by_fields(log, 'messages', get_config().serializer))
+        self.assertIsInstance(serialized[0], bytes)
+        self.assertIsInstance(serialized[1], dict)
+        self.assertEqual([json.loads(split_log) if isinstance(split_log, bytes) else split_log
+                          for split_log in serialized], expected)
+
     @httpretty.activate
     def test_wrong_event(self):
         event = {'awslogs': {}}
@@ -0,0 +1,74 @@
+"""Compare splitting a record by MESSAGES_ARRAY with deep copies and with shared fields.
+
+Both sides include serializing the split logs, which is what the shipper does with them.
+Deep copies take quadratic time, so above LEGACY_SAMPLE messages their time is
+extrapolated from the first LEGACY_SAMPLE copies, which each copy the whole record.
+
+Run from the repository root:
+    python -m python3.kinesis.tests.split_benchmark
+"""
+import copy
+import json
+import timeit
+
+import python3.kinesis.src.lambda_function as worker
+from python3.shipper.serializer import StdlibSerializer
+
+ARRAY_SIZES = (10, 100, 1000, 10000)
+FIELD = 'messages'
+LEGACY_SAMPLE = 100
+
+
+def legacy_split_by_fields(log, field, limit=None):
+    logs = []
+    for msg in log[field][:limit]:
+        temp_log = copy.deepcopy(log)
+        temp_log.update(msg)
+        temp_log.pop(field)
+        logs.append(temp_log)
+    return logs
+
+
+def generate_log(size):
+    # type: (int) -> dict
+    return {
+        'eventSource': 'aws:kinesis',
+        'eventID': 'shardId-000000000000:49545115243490985018280067714973144582180062593244200961',
+        'eventSourceARN': 'arn:aws:kinesis:us-east-1:123456789012:stream/test',
+        'awsRegion': 'us-east-1',
+        'partitionKey': 'partitionKey-03',
+        'sequenceNumber': '49545115243490985018280067714973144582180062593244200961',
+        '@timestamp': '2018-10-17T13:36:27.440000Z',
+        'type': 'kinesis_lambda',
+        FIELD: [{'info': 'message {}'.format(i), 'level': 'low' if i % 2 else 'high', 'duration': i % 1000}
+                for i in range(size)],
+    }
+
+
+def main():
+    serializer = StdlibSerializer()
+    for size in ARRAY_SIZES:
+        log = generate_log(size)
+        limit = min(size, LEGACY_SAMPLE)
+        legacy_lines = [serializer.dumps(split_log) for split_log in legacy_split_by_fields(log, FIELD, limit)]
+        lines = list(worker.split_by_fields(log, FIELD, serializer))
+        assert [json.loads(line) for line in lines[:limit]] == [json.loads(line) for line in legacy_lines]
+
+        repeat = max(1, 1000 // size)
+        legacy_seconds = min(timeit.repeat(
+            lambda: [serializer.dumps(split_log) for split_log in legacy_split_by_fields(log, FIELD, limit)],
+            number=1, repeat=repeat)) * size / limit
+        overlay_seconds = min(timeit.repeat(
+            lambda: [serializer.dumps(split_log) for split_log in worker.split_by_fields(log, FIELD)],
+            number=1, repeat=repeat))
+        seconds = min(timeit.repeat(lambda: list(worker.split_by_fields(log, FIELD, serializer)),
+                                    number=1, repeat=repeat))
+        print('{} messages: deep copies {:.2f} ms{}, shared fields {:.2f} ms ({:.1f}x), '
+              'pre-encoded shared fields {:.2f} ms ({:.1f}x)'.format(
+                  size, legacy_seconds * 1000, ' (extrapolated)' if limit < size else '',
+                  overlay_seconds * 1000, legacy_seconds / overlay_seconds,
+                  seconds * 1000, legacy_seconds / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+import collections
+import itertools
+import json
+import re
+
+from python3.custom_logger import custom_logger
+from python3.shipper.config import get_config
+from python3.shipper.metrics import metrics
+from python3.shipper.serializer import SharedFieldsTemplate
+
+KEY_INDEX = 0
+VALUE_INDEX = 1
+LOG_LEVELS = {'ALERT', 'TRACE', 'DEBUG', 'NOTICE', 'INFO', 'WARN',
+              'WARNING', 'ERROR', 'ERR', 'CRITICAL', 'CRIT',
+              'FATAL', 'SEVERE', 'EMERG', 'EMERGENCY'}
+
+LOG_GROUP_TO_PREFIX = {
+    "/aws/apigateway/": "aws/apigateway",
+    "/aws/rds/cluster/": "aws/rds",
+    "/aws/cloudhsm/": "aws/cloudhsm",
+    "aws-cloudtrail-logs-": "aws/cloudtrail",
+    "/aws/codebuild/": "aws/codebuild",
+    "/aws/connect/": "aws/connect",
+    "/aws/elasticbeanstalk/": "aws/elasticbeanstalk",
+    "/aws/ecs/": "aws/ecs",
+    "/aws/eks/": "aws/eks",
+    "/aws-glue/": "glue",
+    "AWSIotLogsV2": "aws/iot",
+    "/aws/lambda/": "aws/lambda",
+    "/aws/macie/": "aws/macie",
+    "/aws/amazonmq/broker/": "aws/amazonmq"
+}
+
+PYTHON_EVENT_SIZE = 3
+NODEJS_EVENT_SIZE = 4
+# ISO-8601 date and time, or epoch seconds, milliseconds or microseconds
+TIMESTAMP_PATTERN = r'(?:\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:[.,]\d{1,9})?)?' \
+                    r'(?:Z|[+-]\d{2}(?::?\d{2})?)?)?|\d{10}(?:\d{3}){0,2})'
+TIMESTAMP_RE = re.compile(TIMESTAMP_PATTERN + r'\Z')
+# Java runtime: "<timestamp> <request id> <LEVEL> <message>"
+JAVA_LOG_RE = re.compile(r'(' + TIMESTAMP_PATTERN + r') ([0-9a-fA-F]{8}(?:-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}) '
+                         r'([A-Z]+) +(.*)', re.DOTALL)
+LAMBDA_LOG_GROUP = '/aws/lambda/'
+CONTROL_MESSAGE_TYPE = 'CONTROL_MESSAGE'
+# Processing plans of this many log streams are kept across invocations
+PLAN_CACHE_SIZE = 256
+# CloudWatch Logs does not accept bigger events, longer messages were truncated and are not valid JSON
+JSON_MAX_MESSAGE_LENGTH = 256 * 1024
+# Fields of the payload that are needed before its log events can be processed
+LOGS_DATA_HEADER_FIELDS = ('logGroup', 'logStream', 'messageType', 'owner')
+# Fields of the log events before the additional data is merged into them
+EVENT_KEYS = frozenset(['id', 'timestamp', '@timestamp', 'message', 'requestID', 'log_level'])
+
+
+# set logger
+logger = custom_logger.get_logger(__name__)
+
+
+def extract_lambda_log_message(log):
+    # type: (dict) -> None
+    """Parse the fields of Python, Node.js, .NET and Java runtime log lines into the log."""
+    str_message = str(log['message'])
+    start_split = 0
+    start_level = str_message.find('[')
+    if start_level != -1:
+        end_level = str_message.find(']')
+        if end_level > start_level:
+            log_level = str_message[start_level + 1:end_level].upper()
+            if log_level in LOG_LEVELS:
+                log['log_level'] = log_level
+                start_split = end_level + 2
+    message = str_message[start_split:] if start_split else str_message
+    tabs = message.count('\t')
+    if tabs == PYTHON_EVENT_SIZE - 1 or tabs == NODEJS_EVENT_SIZE - 1:
+        # Python: "[LEVEL]\t<timestamp>\t<request id>\t<message>"
+        # Node.js and .NET: "<timestamp>\t<request id>\t<level>\t<message>"
+        message_parts = message.split('\t')
+        if TIMESTAMP_RE.match(message_parts[0]):
+            size = tabs + 1
+            log['@timestamp'] = message_parts[0]
+            log['requestID'] = message_parts[1]
+            log['message'] = message_parts[size - 1]
+            if size == NODEJS_EVENT_SIZE:
+                log['log_level'] = message_parts[2]
+    elif not start_split:
+        java_match = JAVA_LOG_RE.match(message)
+        if java_match is not None and java_match.group(3) in LOG_LEVELS:
+            log['@timestamp'], log['requestID'], log['log_level'], log['message'] = java_match.groups()
+
+
+def _add_timestamp(log):
+    # type: (dict) -> None
+    if '@timestamp' not in log:
+        log['@timestamp'] = str(log['timestamp'])
+        del log['timestamp']
+
+
+class JsonHitRate(object):
+    """Per log group record of how many messages that look like JSON objects actually parse.
+
+    Once a log group had MIN_ATTEMPTS attempts with a hit rate under MIN_HIT_RATE,
+    only one of every PROBE_INTERVAL of its messages is parsed, so a log group that
+    starts logging JSON is noticed again.
+    """
+    MIN_ATTEMPTS = 50
+    MIN_HIT_RATE = 0.05
+    PROBE_INTERVAL = 100
+    # Counts are halved at this number of attempts, so recent messages weigh more
+    MAX_ATTEMPTS = 1000
+    MAX_LOG_GROUPS = 1000
+
+    def __init__(self):
+        # log group -> [attempts, hits, skipped since last attempt]
+        self._log_groups = {}
+
+    def should_parse(self, log_group):
+        # type: (str) -> bool
+        stats = self._log_groups.get(log_group)
+        if stats is None or stats[0] < self.MIN_ATTEMPTS or stats[1] >= stats[0] * self.MIN_HIT_RATE:
+            return True
+        stats[2] += 1
+        if stats[2] >= self.PROBE_INTERVAL:
+            stats[2] = 0
+            return True
+        return False
+
+    def record(self, log_group, hit):
+        # type: (str, bool) -> None
+        stats = self._log_groups.get(log_group)
+        if stats is None:
+            if len(self._log_groups) >= self.MAX_LOG_GROUPS:
+                self._log_groups.clear()
+            stats = self._log_groups[log_group] = [0, 0, 0]
+        stats[0] += 1
+        if hit:
+            stats[1] += 1
+        if stats[0] >= self.MAX_ATTEMPTS:
+            stats[0] //= 2
+            stats[1] //= 2
+
+
+# Kept for the lifetime of the container
+json_hit_rate = JsonHitRate()
+
+
+def _looks_like_json_object(message):
+    # type: (str) -> bool
+    if not isinstance(message, str) or not 2 <= len(message) <= JSON_MAX_MESSAGE_LENGTH:
+        return False
+    first_char = message[0]
+    if first_char == '{':
+        return True
+    return first_char.isspace() and message.lstrip()[:1] == '{'
+
+
+def parse_to_json(log, log_group='', config=None):
+    # type: (dict, str, RuntimeConfig) -> None
+    if not (config or get_config()).format_json:
+        return
+    message = log['message']
+    if not _looks_like_json_object(message):
+        metrics.increment('json_parse_skipped')
+        return
+    if not json_hit_rate.should_parse(log_group):
+        metrics.increment('json_parse_skipped')
+        return
+    try:
+        json_object = json.loads(message)
+    except (ValueError, RecursionError):
+        json_hit_rate.record(log_group, False)
+        metrics.increment('json_parse_failures')
+        return
+    json_hit_rate.record(log_group, True)
+    for key, value in json_object.items():
+        log[key] = value
+
+
+def _parse_event_fields(log, lambda_log_group):
+    # type: (dict, bool) -> None
+    _add_timestamp(log)
+    if lambda_log_group:
+        extract_lambda_log_message(log)
+
+
+def parse_cloudwatch_log(log, additional_data, config=None):
+    # type: (dict, dict, RuntimeConfig) -> bool
+    _parse_event_fields(log, LAMBDA_LOG_GROUP in additional_data['logGroup'])
+    log.update(additional_data)
+    parse_to_json(log, additional_data['logGroup'], config)
+    return True
+
+
+class LogStreamPlan(collections.namedtuple('LogStreamPlan', ['additional_data', 'template', 'lambda_log_group'])):
+    """How the log events of one log stream are processed.
+
+    template is None when the additional data overrides event fields, and the
+    events must be merged with it as dicts.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, additional_data, serializer):
+        # type: (dict, object) -> LogStreamPlan
+        # The additional data overrides the event fields, so it can be spliced in only when they are different
+        template = SharedFieldsTemplate(additional_data, serializer) if EVENT_KEYS.isdisjoint(additional_data) \
+            else None
+        return cls(additional_data, template, LAMBDA_LOG_GROUP in additional_data['logGroup'])
+
+
+class PlanCache(object):
+    """LRU cache of log stream processing plans, kept for the lifetime of the container."""
+
+    def __init__(self, max_size=PLAN_CACHE_SIZE):
+        self._max_size = max_size
+        self._plans = collections.OrderedDict()
+        self._config = None
+
+    def get_plan(self, aws_logs_data, context, config):
+        # type: (dict, 'LambdaContext', RuntimeConfig) -> LogStreamPlan
+        if config is not self._config:
+            # ENRICH, TYPE or the log group prefixes may have changed
+            self._plans.clear()
+            self._config = config
+        key = tuple(aws_logs_data.get(field) for field in LOGS_DATA_HEADER_FIELDS) + \
+            (getattr(context, 'function_version', None), getattr(context, 'invoked_function_arn', None))
+        plan = self._plans.get(key)
+        if plan is not None:
+            self._plans.move_to_end(key)
+            metrics.increment('plan_cache_hits')
+            return plan
+        plan = LogStreamPlan.build(get_additional_logs_data(aws_logs_data, context, config), config.serializer)
+        self._plans[key] = plan
+        if len(self._plans) > self._max_size:
+            self._plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        self._plans.clear()
+
+
+plan_cache = PlanCache()
+
+
+def ship_logs(shipper, log_events, plan, config):
+    # type: (LogzioShipper, iter, LogStreamPlan, RuntimeConfig) -> int
+    logs_count = 0
+    additional_data, template, lambda_log_group = plan
+    log_group = additional_data['logGroup']
+    for log in log_events:
+        if not isinstance(log, dict):
+            raise TypeError(
+                "Expected log inside logEvents to be a dict but found another type")
+        logs_count += 1
+        if template is None:
+            if parse_cloudwatch_log(log, additional_data, config):
+                shipper.add(log)
+            continue
+        _parse_event_fields(log, lambda_log_group)
+        parse_to_json(log, log_group, config)
+        if template.keys.isdisjoint(log):
+            shipper.add_raw(template.dumps(log))
+        else:
+            # Fields parsed from the message override the additional data
+            for key, value in additional_data.items():
+                log.setdefault(key, value)
+            shipper.add(log)
+    return logs_count
+
+
+def get_additional_logs_data(aws_logs_data, context, config=None):
+    # type: (dict, 'LambdaContext', RuntimeConfig) -> dict
+    config = config or get_config()
+    additional_fields = ['logGroup', 'logStream', 'messageType', 'owner']
+    additional_data = dict(
+        (key, aws_logs_data[key]) for key in additional_fields)
+    try:
+        if 'logGroup' in additional_data:
+            namespace = get_service_by_log_group_prefix(
+                additional_data['logGroup'], config)
+            if namespace == '':
+                logger.info(
+                    f'Mapping from log group to namespace does not exist for log group {additional_data["logGroup"]}')
+            else:
+                additional_data['namespace'] = namespace
+        else:
+            logger.info(
+                'Field logGroup does not appear in data. Field namespace will not be added')
+    except Exception as e:
+        logger.warning(f'Error while trying to get namespace: {e}')
+    try:
+        additional_data['function_version'] = context.function_version
+        additional_data['invoked_function_arn'] = context.invoked_function_arn
+    except (KeyError, AttributeError):
+        logger.info(
+            'Failed to find context value. Continue without adding it to the log')
+
+    # If ENRICH has value, add the properties
+    for property_key_value in config.enrich:
+        additional_data[property_key_value[KEY_INDEX]
+                        ] = property_key_value[VALUE_INDEX]
+
+    if config.log_type is not None:
+        additional_data['type'] = config.log_type
+    else:
+        logger.info("Using default TYPE 'logzio_cloudwatch_lambda'.")
+        additional_data['type'] = 'logzio_cloudwatch_lambda'
+    return additional_data
+
+
+def classify_payload(aws_logs_data, log_events):
+    # type: (dict, iter) -> iter | None
+    """The log events to ship, or None for payloads without any, before anything is set up for them."""
+    if aws_logs_data.get('messageType') == CONTROL_MESSAGE_TYPE:
+        # Sent by CloudWatch Logs to check that the destination is reachable
+        logger.debug('Skipping control message')
+        metrics.increment('control_messages')
+        return None
+    first_event = next(log_events, None)
+    if first_event is None:
+        logger.debug('Skipping payload without log events')
+        metrics.increment('empty_payloads')
+        return None
+    return itertools.chain((first_event,), log_events)
+
+
+class PrefixTrie(object):
+    """Maps strings to the value of their longest prefix, in time that does not depend on the number of prefixes."""
+    # Characters are never empty, so the empty key holds the value of a node
+    _VALUE_KEY = ''
+
+    def __init__(self, mapping=()):
+        # type: (iter) -> None
+        self._root = {}
+        for prefix, value in mapping:
+            self.insert(prefix, value)
+
+    def insert(self, prefix, value):
+        # type: (str, object) -> None
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[self._VALUE_KEY] = value
+
+    def longest_prefix_value(self, text, default=None):
+        # type: (str, object) -> object
+        value = self._root.get(self._VALUE_KEY, default)
+        node = self._root
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            value = node.get(self._VALUE_KEY, value)
+        return value
+
+
+_prefix_tries = {}
+
+
+def _get_prefix_trie(config):
+    # type: (RuntimeConfig) -> PrefixTrie
+    trie = _prefix_tries.get(config.log_group_prefixes)
+    if trie is None:
+        # Prefixes from LOG_GROUP_PREFIXES are inserted last, so they override the built-in ones
+        trie = PrefixTrie(list(LOG_GROUP_TO_PREFIX.items()) + list(config.log_group_prefixes))
+        _prefix_tries.clear()
+        _prefix_tries[config.log_group_prefixes] = trie
+    return trie
+
+
+def get_service_by_log_group_prefix(log_group, config=None):
+    # type: (str, RuntimeConfig) -> str
+    return _get_prefix_trie(config or get_config()).longest_prefix_value(log_group, '')
@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from python3.custom_logger import custom_logger
+
+COMPRESSION_LEVEL_ENV = 'COMPRESSION_LEVEL'
+COMPRESSION_THREADS_ENV = 'COMPRESSION_THREADS'
+AUTO_COMPRESSION_LEVEL = 'auto'
+DEFAULT_COMPRESSION_LEVEL = 9
+FASTEST_COMPRESSION_LEVEL = 1
+AUTO_CANDIDATE_LEVELS = (1, 3, 6, 9)
+# Below this much remaining invocation time, CPU is worth more than bytes on the wire
+LOW_REMAINING_TIME_MS = 5000
+# Every REEXPLORE_INTERVAL bulks the least recently measured level is measured again
+REEXPLORE_INTERVAL = 50
+# Weight of the newest sample in the moving averages
+SMOOTHING_FACTOR = 0.3
+# Uncompressed bytes compressed to one gzip member by a compression thread
+COMPRESSION_BLOCK_SIZE = 256 * 1024
+# zlib window bits that make it write a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# set logger
+logger = custom_logger.get_logger(__name__)
+
+
+def get_compression_level():
+    # type: () -> int | str
+    level_str = os.getenv(COMPRESSION_LEVEL_ENV, '').strip().lower()
+    if not level_str:
+        return DEFAULT_COMPRESSION_LEVEL
+    if level_str == AUTO_COMPRESSION_LEVEL:
+        return AUTO_COMPRESSION_LEVEL
+    try:
+        level = int(level_str)
+        if FASTEST_COMPRESSION_LEVEL <= level <= 9:
+            return level
+        logger.warning(f'Compression level input from user is invalid, '
+                       f'reverting to default value {DEFAULT_COMPRESSION_LEVEL}')
+    except ValueError:
+        logger.warning(f'Could not parse compression level input {level_str}, '
+                       f'reverting to default value {DEFAULT_COMPRESSION_LEVEL}')
+    return DEFAULT_COMPRESSION_LEVEL
+
+
+def deflate_bound(size):
+    # type: (int) -> int
+    """Most bytes deflate writes for size bytes of input, as zlib's compressBound computes it."""
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+
+
+def compress_block(data, compresslevel):
+    # type: (bytes, int) -> (bytes, float)
+    """Compress data to one complete gzip member. Returns the member and the seconds it took.
+
+    zlib releases the GIL while it compresses, so blocks compress in parallel on threads.
+    """
+    start_time = time.perf_counter()
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, GZIP_WBITS)
+    member = compressor.compress(data) + compressor.flush()
+    return member, time.perf_counter() - start_time
+
+
+_executor_lock = threading.Lock()
+_executor = None
+_executor_threads = 0
+
+
+def get_compression_executor(threads):
+    # type: (int) -> ThreadPoolExecutor
+    """The thread pool of the container that compresses blocks, created again only when threads changes."""
+    global _executor, _executor_threads
+    with _executor_lock:
+        if _executor is None or _executor_threads != threads:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='compression')
+            _executor_threads = threads
+        return _executor
+
+
+def _smooth(average, sample):
+    if average is None:
+        return sample
+    return average + SMOOTHING_FACTOR * (sample - average)
+
+
+class CompressionLevelTuner(object):
+    """Picks the gzip level that minimizes compression time plus upload time per input byte.
+
+    Each candidate level keeps a moving average of its compression ratio and
+    CPU seconds per input byte, and the upload bandwidth is measured from the
+    bulks that were sent. Statistics live as long as the Lambda container.
+    """
+
+    def __init__(self, levels=AUTO_CANDIDATE_LEVELS):
+        self._levels = levels
+        self._ratio = dict((level, None) for level in levels)
+        self._seconds_per_byte = dict((level, None) for level in levels)
+        self._last_measured = dict((level, 0) for level in levels)
+        self._bytes_per_second = None
+        self._bulks = 0
+        self._lock = threading.Lock()
+
+    def choose_level(self, remaining_time_ms=None):
+        # type: (int) -> int
+        if remaining_time_ms is not None and remaining_time_ms < LOW_REMAINING_TIME_MS:
+            return FASTEST_COMPRESSION_LEVEL
+        with self._lock:
+            self._bulks += 1
+            for level in self._levels:
+                if self._ratio[level] is None:
+                    return level
+            if self._bulks % REEXPLORE_INTERVAL == 0:
+                return min(self._levels, key=lambda level: self._last_measured[level])
+            return min(self._levels, key=self._cost_per_byte)
+
+    def _cost_per_byte(self, level):
+        cost = self._seconds_per_byte[level]
+        if self._bytes_per_second:
+            cost += self._ratio[level] / self._bytes_per_second
+        return cost
+
+    def record(self, level, decompress_size, compress_size, compress_seconds, send_seconds):
+        # type: (int, int, int, float, float) -> None
+        if level not in self._ratio or not decompress_size:
+            return
+        with self._lock:
+            self._ratio[level] = _smooth(self._ratio[level], compress_size / decompress_size)
+            self._seconds_per_byte[level] = _smooth(self._seconds_per_byte[level],
+                                                    compress_seconds / decompress_size)
+            self._last_measured[level] = self._bulks
+            if send_seconds > 0:
+                self._bytes_per_second = _smooth(self._bytes_per_second, compress_size / send_seconds)
+        logger.debug(f'Compression level {level}: ratio {self._ratio[level]:.3f}, '
+                     f'{self._seconds_per_byte[level] * 1e9:.1f} ns per byte')
+
+
+compression_tuner = CompressionLevelTuner()
@@ -0,0 +1,176 @@
+import collections
+import os
+import threading
+
+from python3.custom_logger import custom_logger
+from python3.shipper import compression, retry, serializer, spool, transport
+
+ACCOUNT_TOKEN_ENV = 'TOKEN'
+REGION_ENV = 'REGION'
+URL_ENV = 'LISTENER_URL'
+COMPRESS_ENV = 'COMPRESS'
+TIMEOUT_ENV = 'REQUEST_TIMEOUT'
+SENDER_THREADS_ENV = 'SENDER_THREADS'
+SENDER_QUEUE_SIZE_ENV = 'SENDER_QUEUE_SIZE'
+FORMAT_ENV = 'FORMAT'
+TYPE_ENV = 'TYPE'
+ENRICH_ENV = 'ENRICH'
+MESSAGES_ARRAY_ENV = 'MESSAGES_ARRAY'
+LOG_GROUP_PREFIXES_ENV = 'LOG_GROUP_PREFIXES'
+PARALLEL_WORKERS_ENV = 'PARALLEL_WORKERS'
+PARALLEL_THRESHOLD_ENV = 'PARALLEL_THRESHOLD'
+REPORT_BATCH_ITEM_FAILURES_ENV = 'REPORT_BATCH_ITEM_FAILURES'
+BASE_URL = "https://listener.logz.io:8071"
+DEFAULT_TIMEOUT = 15  # seconds
+DEFAULT_SENDER_QUEUE_SIZE = 2
+# Batches with fewer events are parsed in the handler process even when PARALLEL_WORKERS is set
+DEFAULT_PARALLEL_THRESHOLD = 5000
+# Every variable the configuration is built from, a change in any of them rebuilds it
+CONFIG_ENVS = (ACCOUNT_TOKEN_ENV, REGION_ENV, URL_ENV, COMPRESS_ENV, TIMEOUT_ENV, SENDER_THREADS_ENV,
+               SENDER_QUEUE_SIZE_ENV, FORMAT_ENV, TYPE_ENV, ENRICH_ENV, MESSAGES_ARRAY_ENV, LOG_GROUP_PREFIXES_ENV,
+               PARALLEL_WORKERS_ENV, PARALLEL_THRESHOLD_ENV, REPORT_BATCH_ITEM_FAILURES_ENV,
+               compression.COMPRESSION_LEVEL_ENV, compression.COMPRESSION_THREADS_ENV,
+               retry.MAX_ATTEMPTS_ENV, retry.BASE_DELAY_ENV, retry.MAX_DELAY_ENV, retry.BUDGET_ENV,
+               serializer.SERIALIZER_ENV, serializer.COMPACT_ENV, serializer.ENSURE_ASCII_ENV,
+               transport.POOL_SIZE_ENV, transport.IDLE_TIMEOUT_ENV, spool.SPOOL_DIR_ENV, spool.SPOOL_MAX_SIZE_ENV)
+
+# set logger
+logger = custom_logger.get_logger(__name__)
+
+
+class RuntimeConfig(collections.namedtuple('RuntimeConfig', [
+        'token', 'region', 'listener_url', 'compress', 'compression_level', 'compression_threads', 'timeout',
+        'retry_policy', 'serializer', 'sender_threads', 'sender_queue_size', 'format_json', 'log_type', 'enrich',
+        'messages_array', 'log_group_prefixes', 'parallel_workers', 'parallel_threshold',
+        'report_batch_item_failures', 'connection_pool_size', 'connection_idle_timeout', 'spool_dir',
+        'spool_max_size'])):
+    """Configuration of the shipper and the handlers, validated once and read-only.
+
+    listener_url does not include the token, which is None when TOKEN is not set.
+    log_type is None when TYPE is not set, so every handler keeps its own default.
+    enrich holds the ENRICH properties, each split on "=" to its key and value.
+    log_group_prefixes holds the (log group prefix, namespace) pairs of LOG_GROUP_PREFIXES.
+    spool_dir is None when SPOOL_DIR is not set, and spool_max_size is in bytes.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_env(cls):
+        # type: () -> RuntimeConfig
+        enrich = os.getenv(ENRICH_ENV)
+        region = os.getenv(REGION_ENV) or None
+        return cls(token=os.getenv(ACCOUNT_TOKEN_ENV),
+                   region=region,
+                   listener_url=_get_listener_url(region),
+                   compress=os.getenv(COMPRESS_ENV, '').lower() == "true",
+                   compression_level=compression.get_compression_level(),
+                   compression_threads=get_number_env(compression.COMPRESSION_THREADS_ENV, 0, min_value=0),
+                   timeout=_get_timeout(),
+                   retry_policy=_get_retry_policy(),
+                   serializer=serializer.get_serializer(),
+                   sender_threads=get_number_env(SENDER_THREADS_ENV, 0, min_value=0),
+                   sender_queue_size=get_number_env(SENDER_QUEUE_SIZE_ENV, DEFAULT_SENDER_QUEUE_SIZE, min_value=0),
+                   format_json=os.getenv(FORMAT_ENV, '').lower() == 'json',
+                   log_type=os.getenv(TYPE_ENV),
+                   enrich=tuple(tuple(prop.split("=")) for prop in enrich.split(";")) if enrich else (),
+                   messages_array=os.getenv(MESSAGES_ARRAY_ENV) or None,
+                   log_group_prefixes=_get_log_group_prefixes(),
+                   parallel_workers=get_number_env(PARALLEL_WORKERS_ENV, 0, min_value=0),
+                   parallel_threshold=get_number_env(PARALLEL_THRESHOLD_ENV, DEFAULT_PARALLEL_THRESHOLD),
+                   report_batch_item_failures=os.getenv(REPORT_BATCH_ITEM_FAILURES_ENV, '').lower() == "true",
+                   connection_pool_size=get_number_env(transport.POOL_SIZE_ENV, transport.DEFAULT_POOL_SIZE),
+                   connection_idle_timeout=get_number_env(transport.IDLE_TIMEOUT_ENV, transport.DEFAULT_IDLE_TIMEOUT),
+                   spool_dir=os.getenv(spool.SPOOL_DIR_ENV) or None,
+                   spool_max_size=spool.get_spool_max_size())
+
+
+def get_region_code(region):
+    # type: (str) -> str
+    if region and region != "us":
+        return "-{}".format(region)
+    return ""
+
+
+def get_base_api_url(region):
+    # type: (str) -> str
+    return BASE_URL.replace("listener.", "listener{}.".format(get_region_code(region)))
+
+
+def _get_listener_url(region):
+    # type: (str | None) -> str
+    url = BASE_URL
+    if os.environ.get(URL_ENV):
+        url = os.environ.get(URL_ENV)
+        logger.warning(
+            "Environment variable URL is deprecated and will not be supported in the future. Use REGION instead")
+    if region:
+        url = get_base_api_url(region)
+    return url
+
+
+def _get_log_group_prefixes():
+    # type: () -> tuple
+    prefixes = []
+    for mapping in os.getenv(LOG_GROUP_PREFIXES_ENV, '').split(";"):
+        if not mapping.strip():
+            continue
+        prefix, separator, namespace = mapping.rpartition("=")
+        if not separator or not prefix or not namespace:
+            logger.warning(f'Could not parse log group prefix mapping {mapping}, expected <prefix>=<namespace>')
+            continue
+        prefixes.append((prefix, namespace))
+    return tuple(prefixes)
+
+
+def get_number_env(name, default, number_type=int, min_value=1):
+    # type: (str, int | float | None, type, int | float) -> int | float | None
+    value_str = os.getenv(name)
+    if not value_str:
+        return default
+    try:
+        value = number_type(value_str)
+        if value >= min_value:
+            return value
+        logger.warning(f'{name} input from user is invalid, reverting to default value {default}')
+    except ValueError:
+        logger.warning(f'Could not parse {name} input {value_str}, reverting to default value {default}')
+    return default
+
+
+def _get_retry_policy():
+    # type: () -> retry.RetryPolicy
+    return retry.RetryPolicy(
+        max_attempts=max(get_number_env(retry.MAX_ATTEMPTS_ENV, retry.DEFAULT_MAX_ATTEMPTS, min_value=0), 1),
+        base_delay=get_number_env(retry.BASE_DELAY_ENV, retry.DEFAULT_BASE_DELAY, float, min_value=0),
+        max_delay=get_number_env(retry.MAX_DELAY_ENV, retry.DEFAULT_MAX_DELAY, float, min_value=0),
+        budget=get_number_env(retry.BUDGET_ENV, None, float, min_value=0))
+
+
+def _get_timeout():
+    timeout_str = os.getenv(TIMEOUT_ENV)
+    if timeout_str:
+        try:
+            timeout = int(timeout_str)
+            if timeout > 0:
+                return timeout
+            logger.warning(f'Timeout input from user is invalid, reverting to default value {DEFAULT_TIMEOUT}')
+        except ValueError:
+            logger.warning(f'Could not parse timeout input {timeout_str}, reverting to default value {DEFAULT_TIMEOUT}')
+    return DEFAULT_TIMEOUT
+
+
+_cache_lock = threading.Lock()
+_cached_env = None
+_cached_config = None
+
+
+def get_config():
+    # type: () -> RuntimeConfig
+    """The configuration of the container, built again only when one of its environment variables changed."""
+    global _cached_env, _cached_config
+    env = tuple(os.environ.get(name) for name in CONFIG_ENVS)
+    with _cache_lock:
+        if env != _cached_env:
+            _cached_config = RuntimeConfig.from_env()
+            _cached_env = env
+        return _cached_config
@@ -0,0 +1,136 @@
+import collections
+import hashlib
+
+# Prefix of the records that the Kinesis Producer Library aggregated
+KPL_MAGIC = b'\xf3\x89\x9a\xc2'
+# MD5 digest of the protobuf message, which follows it
+DIGEST_SIZE = 16
+# Protobuf wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+# Field numbers of the AggregatedRecord and Record messages
+PARTITION_KEY_TABLE = 1
+EXPLICIT_HASH_KEY_TABLE = 2
+RECORDS = 3
+PARTITION_KEY_INDEX = 1
+EXPLICIT_HASH_KEY_INDEX = 2
+DATA = 3
+
+UserRecord = collections.namedtuple('UserRecord', ['partition_key', 'explicit_hash_key', 'sub_sequence_number',
+                                                   'data'])
+
+
+class AggregationError(ValueError):
+    pass
+
+
+def is_aggregated(data):
+    # type: (bytes | memoryview) -> bool
+    return len(data) > len(KPL_MAGIC) + DIGEST_SIZE and data[:len(KPL_MAGIC)] == KPL_MAGIC
+
+
+def _read_varint(buffer, position, end):
+    # type: (memoryview, int, int) -> (int, int)
+    result = 0
+    shift = 0
+    while position < end:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+        if shift >= 64:
+            raise AggregationError('Varint is longer than 64 bits')
+    raise AggregationError('Truncated varint')
+
+
+def _fields(buffer, start, end):
+    # type: (memoryview, int, int) -> iter
+    """Yields (field number, wire type, value) for the fields of the protobuf message in buffer[start:end].
+
+    The value of a length delimited field is its (start, end) in buffer, so
+    nothing is copied, and fixed size fields have None.
+    """
+    position = start
+    while position < end:
+        key, position = _read_varint(buffer, position, end)
+        field_number, wire_type = key >> 3, key & 0x7
+        if wire_type == VARINT:
+            value, position = _read_varint(buffer, position, end)
+        elif wire_type == LENGTH_DELIMITED:
+            length, position = _read_varint(buffer, position, end)
+            value = (position, position + length)
+            position += length
+        elif wire_type == FIXED64:
+            value = None
+            position += 8
+        elif wire_type == FIXED32:
+            value = None
+            position += 4
+        else:
+            raise AggregationError(f'Unsupported protobuf wire type {wire_type}')
+        if position > end:
+            raise AggregationError(f'Truncated protobuf field {field_number}')
+        yield field_number, wire_type, value
+
+
+def deaggregate(data):
+    # type: (bytes | memoryview) -> iter
+    """The user records of a KPL aggregated record, as an iterator of UserRecord.
+
+    The MD5 digest is verified and the key tables are read before this returns,
+    and an AggregationError is raised if they are not valid. The user records
+    are decoded only as they are iterated, which raises AggregationError for a
+    malformed one. The data of each user record is a memoryview of data instead
+    of a copy.
+    """
+    view = memoryview(data)
+    if not is_aggregated(view):
+        raise AggregationError('Record is not aggregated')
+    message = view[len(KPL_MAGIC):-DIGEST_SIZE]
+    if hashlib.md5(message).digest() != view[-DIGEST_SIZE:]:
+        raise AggregationError('MD5 digest of aggregated record does not match')
+
+    partition_keys = []
+    explicit_hash_keys = []
+    records = []
+    for field_number, wire_type, value in _fields(message, 0, len(message)):
+        if wire_type != LENGTH_DELIMITED:
+            continue
+        start, end = value
+        try:
+            if field_number == PARTITION_KEY_TABLE:
+                partition_keys.append(str(message[start:end], 'utf-8'))
+            elif field_number == EXPLICIT_HASH_KEY_TABLE:
+                explicit_hash_keys.append(str(message[start:end], 'utf-8'))
+            elif field_number == RECORDS:
+                records.append(value)
+        except UnicodeDecodeError:
+            raise AggregationError('Key of aggregated record is not valid UTF-8')
+    return _user_records(message, partition_keys, explicit_hash_keys, records)
+
+
+def _user_records(message, partition_keys, explicit_hash_keys, records):
+    for sub_sequence_number, (start, end) in enumerate(records):
+        partition_key_index = None
+        explicit_hash_key_index = None
+        data = None
+        for field_number, wire_type, value in _fields(message, start, end):
+            if field_number == PARTITION_KEY_INDEX and wire_type == VARINT:
+                partition_key_index = value
+            elif field_number == EXPLICIT_HASH_KEY_INDEX and wire_type == VARINT:
+                explicit_hash_key_index = value
+            elif field_number == DATA and wire_type == LENGTH_DELIMITED:
+                data = message[value[0]:value[1]]
+        if partition_key_index is None or data is None:
+            raise AggregationError(f'User record {sub_sequence_number} misses its partition key or data')
+        try:
+            partition_key = partition_keys[partition_key_index]
+            explicit_hash_key = explicit_hash_keys[explicit_hash_key_index] \
+                if explicit_hash_key_index is not None else None
+        except IndexError:
+            raise AggregationError(f'User record {sub_sequence_number} has a key index out of its table')
+        yield UserRecord(partition_key, explicit_hash_key, sub_sequence_number, data)
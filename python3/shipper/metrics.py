@@ -0,0 +1,62 @@
+import json
+import threading
+
+from python3.custom_logger import custom_logger
+
+# set logger
+logger = custom_logger.get_logger(__name__)
+
+
+class Metrics(object):
+    """Counters and gauges of the shipper, logged as one line at the end of each invocation.
+
+    Counters are reset after they are reported, gauges keep their last value
+    for as long as the Lambda container lives.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        # type: (str, int | float) -> None
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        # type: (str, int | float) -> None
+        with self._lock:
+            self._gauges[name] = value
+
+    def get(self, name, default=0):
+        with self._lock:
+            if name in self._counters:
+                return self._counters[name]
+            return self._gauges.get(name, default)
+
+    def snapshot(self):
+        # type: () -> dict
+        with self._lock:
+            values = dict(self._gauges)
+            values.update(self._counters)
+        return values
+
+    def take_counters(self):
+        # type: () -> dict
+        """Counters since they were last reported or taken, reset without logging them."""
+        with self._lock:
+            counters, self._counters = self._counters, {}
+        return counters
+
+    def report(self):
+        with self._lock:
+            values = dict(self._gauges)
+            values.update(self._counters)
+            self._counters = {}
+        if values:
+            logger.info("Shipper metrics: {}".format(json.dumps(values, sort_keys=True)))
+        return values
+
+
+metrics = Metrics()
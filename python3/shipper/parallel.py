@@ -0,0 +1,242 @@
+import bisect
+import itertools
+import multiprocessing
+
+from python3.custom_logger import custom_logger
+from python3.shipper.compression import AUTO_COMPRESSION_LEVEL, compress_block, compression_tuner
+from python3.shipper.metrics import metrics
+
+# Events or records a worker process parses at a time
+CHUNK_SIZE = 1000
+# Uncompressed bytes of logs in one gzip member, well under the maximum bulk size once compressed
+MEMBER_SIZE = 1024 * 1024
+
+# set logger
+logger = custom_logger.get_logger(__name__)
+# Forked workers start without importing the handler again
+_process_context = multiprocessing.get_context('fork')
+
+
+class WorkerError(Exception):
+    pass
+
+
+def _worker_loop(connection):
+    # Counters of the parent, copied by the fork, are reported by the parent
+    metrics.take_counters()
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        func, args = task
+        try:
+            connection.send((True, func(*args)))
+        except Exception as e:
+            try:
+                connection.send((False, e))
+            except Exception:
+                # The exception could not be pickled
+                connection.send((False, WorkerError(f'{type(e).__name__}: {e}')))
+    connection.close()
+
+
+class ProcessPool(object):
+    """Worker processes that get tasks and return results through pipes.
+
+    multiprocessing.Pool and Queue need /dev/shm, which Lambda does not have,
+    so every worker gets a Pipe of its own. Workers are forked, so the pool
+    must be started before the shipper starts any sender threads.
+    """
+
+    def __init__(self, workers):
+        # type: (int) -> None
+        self._connections = []
+        self._processes = []
+        for _ in range(workers):
+            parent_connection, child_connection = _process_context.Pipe()
+            process = _process_context.Process(target=_worker_loop, args=(child_connection,), daemon=True)
+            process.start()
+            child_connection.close()
+            self._connections.append(parent_connection)
+            self._processes.append(process)
+
+    def imap(self, func, args_iterable):
+        """Yields func(*args) for every args, in order.
+
+        Each worker has a single task in flight, so neither side of a pipe ever
+        blocks on a send while the other side is sending too.
+        """
+        args_iterator = iter(args_iterable)
+        in_flight = []
+        for connection in self._connections:
+            args = next(args_iterator, None)
+            if args is None:
+                break
+            connection.send((func, args))
+            in_flight.append(connection)
+        while in_flight:
+            connection = in_flight.pop(0)
+            try:
+                ok, result = connection.recv()
+            except EOFError:
+                raise WorkerError('Worker process exited unexpectedly')
+            if not ok:
+                raise result
+            args = next(args_iterator, None)
+            if args is not None:
+                connection.send((func, args))
+                in_flight.append(connection)
+            yield result
+
+    def close(self):
+        for connection in self._connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+        for process in self._processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+
+
+class LinesCollector(object):
+    """Collects serialized logs in place of a LogzioShipper, for the handler code that runs in workers."""
+
+    def __init__(self, serializer):
+        self._serializer = serializer
+        self.lines = []
+        # (first line, tags) of the logs added after every set_tags
+        self.tag_ranges = []
+
+    def add(self, log):
+        # type: (dict) -> None
+        self.lines.append(self._serializer.dumps(log))
+
+    def add_raw(self, log, validate=False):
+        # type: (str | bytes, bool) -> None
+        json_log = log.encode('utf-8') if isinstance(log, str) else bytes(log)
+        if b"\n" in json_log:
+            json_log = json_log.replace(b"\r\n", b" ").replace(b"\n", b" ")
+        self.lines.append(json_log)
+
+    def set_tags(self, tags):
+        # type: (iterable) -> None
+        if self.tag_ranges and self.tag_ranges[-1][0] == len(self.lines):
+            self.tag_ranges.pop()
+        self.tag_ranges.append((len(self.lines), tuple(tags)))
+
+    def add_many(self, logs):
+        # type: (iterable) -> int
+        added = 0
+        for log in logs:
+            if isinstance(log, dict):
+                self.add(log)
+            else:
+                self.add_raw(log)
+            added += 1
+        return added
+
+
+def compress_members(lines, compresslevel, member_size=MEMBER_SIZE):
+    # type: (list, int, int) -> list
+    """Compress serialized logs to gzip members of about member_size uncompressed bytes.
+
+    Returns (member, logs count, uncompressed size, compression seconds) for every member.
+    """
+    members = []
+    start = 0
+    while start < len(lines):
+        end = start
+        size = 0
+        while end < len(lines) and (end == start or size + len(lines[end]) < member_size):
+            size += len(lines[end]) + 1
+            end += 1
+        data = b"\n".join(lines[start:end])
+        member, compress_seconds = compress_block(data, compresslevel)
+        members.append((member, end - start, len(data), compress_seconds))
+        start = end
+    return members
+
+
+def _process_chunk(process, chunk, args, serializer, compresslevel):
+    collector = LinesCollector(serializer)
+    process(collector, chunk, *args)
+    counters = metrics.take_counters()
+    if compresslevel is None:
+        return counters, len(collector.lines), collector.lines, None, collector.tag_ranges, None
+    return counters, len(collector.lines), None, compress_members(collector.lines, compresslevel), \
+        collector.tag_ranges, compresslevel
+
+
+def _tag_ranges_between(tag_ranges, start, end):
+    # type: (list, int, int) -> list
+    """The (first line, tags) ranges of lines start to end, with their first lines counted from start."""
+    index = max(bisect.bisect_right([first for first, _ in tag_ranges], start) - 1, 0)
+    return [(max(first - start, 0), tags) for first, tags in tag_ranges[index:] if first < end]
+
+
+def _chunk_compresslevel(shipper, config):
+    # type: (LogzioShipper, RuntimeConfig) -> int | None
+    """The level a worker compresses its next chunk at, chosen by the parent so the tuner sees every chunk."""
+    if not config.compress:
+        return None
+    if config.compression_level == AUTO_COMPRESSION_LEVEL:
+        return compression_tuner.choose_level(shipper._get_remaining_time_ms())
+    return config.compression_level
+
+
+def _chunks(items, chunk_size):
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def ship_in_parallel(shipper, items, process, args, config, chunk_size=CHUNK_SIZE):
+    # type: (LogzioShipper, iter, callable, tuple, RuntimeConfig, int) -> int
+    """Run process(collector, chunk, *args) on chunks of items in config.parallel_workers processes.
+
+    process must be a module level function that adds the logs of a chunk to the
+    collector. Workers serialize, and compress when enabled, the logs of their
+    chunks, and the members are added to the shipper in the order of the items.
+    Tags that process sets on the collector are set on the shipper for the same
+    logs, so bulks that fail to ship are tracked by the items of their logs.
+    With the auto compression level, the level of every chunk is chosen here and
+    the compression time of the workers is recorded when their bulks are sent.
+    Returns the number of logs added.
+    """
+    logger.info(f'Parsing in {config.parallel_workers} worker processes')
+    pool = ProcessPool(config.parallel_workers)
+    logs_count = 0
+    tasks = ((process, chunk, args, config.serializer, _chunk_compresslevel(shipper, config))
+             for chunk in _chunks(items, chunk_size))
+    try:
+        for result in pool.imap(_process_chunk, tasks):
+            counters, chunk_logs_count, lines, members, tag_ranges, compresslevel = result
+            for name, value in counters.items():
+                metrics.increment(name, value)
+            if members is not None:
+                start = 0
+                for member, member_logs_count, decompress_size, compress_seconds in members:
+                    shipper.add_gzip_member(member, member_logs_count, decompress_size,
+                                            _tag_ranges_between(tag_ranges, start, start + member_logs_count),
+                                            compresslevel, compress_seconds)
+                    start += member_logs_count
+            else:
+                tag_starts = dict(tag_ranges)
+                for index, line in enumerate(lines):
+                    if not index or index in tag_starts:
+                        shipper.set_tags(tag_starts.get(index, ()))
+                    shipper.add_raw(line)
+            logs_count += chunk_logs_count
+    finally:
+        pool.close()
+        shipper.set_tags(())
+    return logs_count
@@ -0,0 +1,88 @@
+import email.utils
+import random
+import time
+
+from python3.custom_logger import custom_logger
+
+MAX_ATTEMPTS_ENV = 'RETRY_MAX_ATTEMPTS'
+BASE_DELAY_ENV = 'RETRY_BASE_DELAY'
+MAX_DELAY_ENV = 'RETRY_MAX_DELAY'
+BUDGET_ENV = 'RETRY_BUDGET'
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BASE_DELAY = 2  # seconds
+DEFAULT_MAX_DELAY = 30  # seconds
+# Time kept free at the end of the invocation for flushing and returning
+DEADLINE_MARGIN_SECONDS = 1
+
+# set logger
+logger = custom_logger.get_logger(__name__)
+
+
+def parse_retry_after(headers):
+    # type: (http.client.HTTPMessage) -> float | None
+    """Seconds to wait according to a Retry-After header, given as seconds or as an HTTP date."""
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logger.debug(f'Could not parse Retry-After header {value}')
+        return None
+    if retry_at is None:
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+class RetryPolicy(object):
+    """Exponential backoff with full jitter, bounded by a retry budget and the invocation deadline."""
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY, budget=None, status_errors=None):
+        # type: (int, float, float, float, dict) -> None
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Maximum total seconds slept between attempts of one bulk, None for no limit
+        self.budget = budget
+        # HTTP status code -> exception raised without retrying
+        self.status_errors = status_errors or {}
+
+    def with_status_errors(self, status_errors):
+        # type: (dict) -> RetryPolicy
+        return RetryPolicy(self.max_attempts, self.base_delay, self.max_delay, self.budget, status_errors)
+
+    def error_for(self, status_code):
+        # type: (int) -> type | None
+        return self.status_errors.get(status_code)
+
+    def backoff(self, retry_number):
+        # type: (int) -> float
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry_number))
+
+    def next_delay(self, retry_number, slept, remaining_ms=None, reserved_seconds=0, min_delay=None):
+        # type: (int, float, int, float, float) -> float | None
+        """Seconds to sleep before retry number retry_number, or None when there is no time left for it.
+
+        reserved_seconds is the time the next attempt needs after the sleep, and
+        min_delay is the wait the listener asked for with Retry-After.
+        """
+        delay = self.backoff(retry_number)
+        if min_delay is not None:
+            if min_delay > self.max_delay:
+                return None
+            delay = max(delay, min_delay)
+        available = None
+        if self.budget is not None:
+            available = self.budget - slept
+        if remaining_ms is not None:
+            deadline_available = remaining_ms / 1000 - DEADLINE_MARGIN_SECONDS - reserved_seconds
+            available = deadline_available if available is None else min(available, deadline_available)
+        if available is None:
+            return delay
+        if available < 0 or (min_delay is not None and min_delay > available):
+            return None
+        return min(delay, available)
@@ -0,0 +1,157 @@
+import json
+import os
+
+from python3.custom_logger import custom_logger
+
+# Optional backends, used only when they are packaged with the function
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+SERIALIZER_ENV = 'JSON_SERIALIZER'
+COMPACT_ENV = 'JSON_COMPACT'
+ENSURE_ASCII_ENV = 'JSON_ENSURE_ASCII'
+STDLIB_SERIALIZER = 'json'
+ORJSON_SERIALIZER = 'orjson'
+UJSON_SERIALIZER = 'ujson'
+AUTO_SERIALIZER = 'auto'
+COMPACT_SEPARATORS = (',', ':')
+DEFAULT_ITEM_SEPARATOR = ', '
+
+# set logger
+logger = custom_logger.get_logger(__name__)
+
+
+class StdlibSerializer(object):
+    """json.dumps. With the default settings the output is exactly what the shipper always sent."""
+    name = STDLIB_SERIALIZER
+    # JSON_COMPACT=false and JSON_ENSURE_ASCII=true are honored
+    spaced = True
+    escapes_non_ascii = True
+
+    def __init__(self, compact=False, ensure_ascii=True):
+        self._separators = COMPACT_SEPARATORS if compact else None
+        self._ensure_ascii = ensure_ascii
+        self.item_separator = (COMPACT_SEPARATORS[0] if compact else DEFAULT_ITEM_SEPARATOR).encode('utf-8')
+
+    def dumps(self, obj):
+        # type: (object) -> bytes
+        return json.dumps(obj, separators=self._separators, ensure_ascii=self._ensure_ascii).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        # type: (str | bytes) -> object
+        return json.loads(data)
+
+
+class OrjsonSerializer(object):
+    """orjson, always compact and UTF-8. Falls back to json for values orjson rejects, like huge integers."""
+    name = ORJSON_SERIALIZER
+    item_separator = b','
+    spaced = False
+    escapes_non_ascii = False
+
+    def __init__(self, compact=True, ensure_ascii=False):
+        # The options are taken for a uniform constructor, get_serializer warns when they are not honored
+        self._fallback = StdlibSerializer(compact=True, ensure_ascii=False)
+
+    def dumps(self, obj):
+        # type: (object) -> bytes
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return self._fallback.dumps(obj)
+
+    @staticmethod
+    def loads(data):
+        # type: (str | bytes) -> object
+        return orjson.loads(data)
+
+
+class UjsonSerializer(object):
+    """ujson. Its output is always compact."""
+    name = UJSON_SERIALIZER
+    item_separator = b','
+    spaced = False
+    escapes_non_ascii = True
+
+    def __init__(self, compact=True, ensure_ascii=True):
+        self._ensure_ascii = ensure_ascii
+        self._fallback = StdlibSerializer(compact=True, ensure_ascii=ensure_ascii)
+
+    def dumps(self, obj):
+        # type: (object) -> bytes
+        try:
+            return ujson.dumps(obj, ensure_ascii=self._ensure_ascii, escape_forward_slashes=False).encode('utf-8')
+        except (TypeError, OverflowError):
+            return self._fallback.dumps(obj)
+
+    @staticmethod
+    def loads(data):
+        # type: (str | bytes) -> object
+        return ujson.loads(data)
+
+
+SERIALIZERS = {STDLIB_SERIALIZER: StdlibSerializer}
+if ujson is not None:
+    SERIALIZERS[UJSON_SERIALIZER] = UjsonSerializer
+if orjson is not None:
+    SERIALIZERS[ORJSON_SERIALIZER] = OrjsonSerializer
+# Fastest backend found at import time
+FASTEST_SERIALIZER = ORJSON_SERIALIZER if orjson is not None \
+    else UJSON_SERIALIZER if ujson is not None \
+    else STDLIB_SERIALIZER
+
+
+def _get_bool_env(name, default):
+    value = os.getenv(name)
+    if not value:
+        return default
+    return value.lower() == 'true'
+
+
+def get_serializer():
+    """The serializer configured by JSON_SERIALIZER, JSON_COMPACT and JSON_ENSURE_ASCII."""
+    name = os.getenv(SERIALIZER_ENV, STDLIB_SERIALIZER).strip().lower()
+    if name == AUTO_SERIALIZER:
+        name = FASTEST_SERIALIZER
+    if name not in SERIALIZERS:
+        logger.warning(f'JSON serializer {name} is not available, reverting to {STDLIB_SERIALIZER}')
+        name = STDLIB_SERIALIZER
+    serializer_class = SERIALIZERS[name]
+    compact = _get_bool_env(COMPACT_ENV, False)
+    ensure_ascii = _get_bool_env(ENSURE_ASCII_ENV, True)
+    # Only options that were set explicitly are worth a warning, the defaults are those of json
+    if os.getenv(COMPACT_ENV) and not compact and not serializer_class.spaced:
+        logger.warning(f'JSON serializer {name} output is always compact, ignoring {COMPACT_ENV}=false')
+    if os.getenv(ENSURE_ASCII_ENV) and ensure_ascii and not serializer_class.escapes_non_ascii:
+        logger.warning(f'JSON serializer {name} always sends non-ASCII characters as UTF-8, '
+                       f'ignoring {ENSURE_ASCII_ENV}=true')
+    return serializer_class(compact=compact, ensure_ascii=ensure_ascii)
+
+
+class SharedFieldsTemplate(object):
+    """Serializes objects that all get the same additional fields, encoding those fields only once.
+
+    The encoded shared fields are spliced before the closing brace of each
+    serialized object, so the objects must not have any of the shared keys.
+    """
+
+    def __init__(self, shared_fields, serializer=None):
+        # type: (dict, object) -> None
+        self.serializer = serializer or get_serializer()
+        self.keys = frozenset(shared_fields)
+        self._fragment = self.serializer.dumps(shared_fields)[1:-1]
+        self._suffix = self.serializer.item_separator + self._fragment + b'}' if self._fragment else b'}'
+
+    def dumps(self, obj):
+        # type: (dict) -> bytes
+        json_obj = self.serializer.dumps(obj)
+        if len(json_obj) == 2:
+            return b'{' + self._fragment + b'}'
+        return json_obj[:-1] + self._suffix
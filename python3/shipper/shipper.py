@@ -1,13 +1,22 @@
+import bisect
 import gzip
 import io
-import json
 import os
-import sys
+import threading
 import time
 import urllib
-import urllib.request
+import urllib.error
 
+from concurrent.futures import ThreadPoolExecutor
 from python3.custom_logger import custom_logger
+from python3.shipper import config as runtime_config
+from python3.shipper.compression import AUTO_COMPRESSION_LEVEL, COMPRESSION_BLOCK_SIZE, DEFAULT_COMPRESSION_LEVEL, \
+    compress_block, compression_tuner, deflate_bound, get_compression_executor
+from python3.shipper.metrics import metrics
+from python3.shipper.retry import DEADLINE_MARGIN_SECONDS, RetryPolicy, parse_retry_after
+from python3.shipper.spool import get_spool
+from python3.shipper.throttling import rate_controller
+from python3.shipper.transport import get_connection_pool
 
 # set logger
 logger = custom_logger.get_logger(__name__)
@@ -29,16 +38,26 @@ class UnknownURL(Exception):
     pass
 
 
+# HTTP status codes that are not worth retrying
+STATUS_ERRORS = {400: BadLogsException,
+                 401: UnauthorizedAccessException,
+                 404: UnknownURL}
+
+# Near the maximum size, a bulk is counted exactly only when at least this fraction of it was written since it last
+# was, otherwise it is sealed, as every exact count moves the limit closer by only the compressed size of that data
+MIN_EXACT_COUNT_FRACTION = 1 / 64
+
+
 class GzipLogRequest(object):
+    # Bytes appended by GzipFile.close(): CRC32 and uncompressed size
+    GZIP_TRAILER_SIZE = 8
 
-    def __init__(self, max_size_in_bytes):
+    def __init__(self, max_size_in_bytes, compresslevel=DEFAULT_COMPRESSION_LEVEL):
         self._max_size_in_bytes = max_size_in_bytes
-        self._decompress_size = 0
-        self._logs_counter = 0
-        self._logs = io.BytesIO()
-        self._writer = gzip.GzipFile(mode='wb', fileobj=self._logs)
+        self.compresslevel = compresslevel
         self._http_headers = {"Content-Encoding": "gzip",
                               "Content-type": "application/json"}
+        self.reset()
 
     def __len__(self):
         return self._logs_counter
@@ -46,16 +65,31 @@ class GzipLogRequest(object):
     def bytes(self):
         return bytes(self._logs.getvalue())
 
+    def body(self):
+        # type: () -> memoryview
+        """The closed request body, as a view of the compressed buffer instead of a copy."""
+        return self._logs.getbuffer()
+
     def write(self, log):
-        self._writer.write(bytes(
-            "\n" + log, 'utf-8')) if self._logs_counter else self._writer.write(bytes(log, 'utf-8'))
+        # type: (str | bytes) -> None
+        data = log.encode('utf-8') if isinstance(log, str) else log
+        if self._logs_counter:
+            data = b"\n" + data
+        start_time = time.perf_counter()
+        self._writer.write(data)
+        self._compress_seconds += time.perf_counter() - start_time
+        self._decompress_size += len(data)
         self._logs_counter += 1
 
     def reset(self):
         self._decompress_size = 0
         self._logs_counter = 0
-        self._logs.truncate(0)
-        self._writer = gzip.GzipFile(mode='wb', fileobj=self._logs)
+        self._compress_seconds = 0.0
+        self._logs = io.BytesIO()
+        self._writer = gzip.GzipFile(mode='wb', fileobj=self._logs, compresslevel=self.compresslevel)
+        # Uncompressed size at the moment zlib last emitted compressed output
+        self._emitted_decompress_size = 0
+        self._emitted_compress_size = self._logs.tell()
 
     def decompress_size(self):
         return self._decompress_size
@@ -63,16 +97,218 @@ class GzipLogRequest(object):
     def compress_size(self):
         old_file_position = self._logs.tell()
         self._logs.seek(0, os.SEEK_END)
-        self._logs.seek(0, os.SEEK_END)
         size = self._logs.tell()
         self._logs.seek(old_file_position, os.SEEK_SET)
         return size
 
+    def compress_size_estimate(self, additional_bytes=0):
+        # type: (int) -> int
+        """Estimate the closed body size without flushing the compressor.
+
+        zlib holds back recently written data, so the bytes still pending are
+        extrapolated with the compression ratio observed so far.
+        """
+        compress_size = self._logs.tell()
+        if compress_size > self._emitted_compress_size:
+            self._emitted_compress_size = compress_size
+            self._emitted_decompress_size = self._decompress_size
+        pending_size = self._decompress_size - self._emitted_decompress_size + additional_bytes
+        if self._emitted_decompress_size:
+            pending_size = pending_size * compress_size // self._emitted_decompress_size
+        return compress_size + pending_size + self.GZIP_TRAILER_SIZE
+
+    def _compress_size_bound(self, additional_bytes):
+        # type: (int) -> int
+        pending_size = self._decompress_size - self._emitted_decompress_size + additional_bytes
+        return self._logs.tell() + deflate_bound(pending_size) + self.GZIP_TRAILER_SIZE
+
+    def fits(self, additional_bytes, max_size_in_bytes):
+        # type: (int, int) -> bool
+        """Whether the closed body stays within max_size_in_bytes after writing additional_bytes more.
+
+        Only when the estimate is too close to the limit to tell, the compressor
+        is flushed so that the bytes it holds back are counted exactly.
+        """
+        if self._logs_counter:
+            additional_bytes += 1
+        if self.compress_size_estimate(additional_bytes) > max_size_in_bytes:
+            return False
+        if self._compress_size_bound(additional_bytes) <= max_size_in_bytes:
+            return True
+        if self._decompress_size - self._emitted_decompress_size < max_size_in_bytes * MIN_EXACT_COUNT_FRACTION:
+            return False
+        self.flush()
+        return self._compress_size_bound(additional_bytes) <= max_size_in_bytes
+
+    def compress_seconds(self):
+        return self._compress_seconds
+
+    def lines(self):
+        # type: () -> list
+        # Serialized logs never contain a raw newline, so the body can be split back into them
+        return gzip.decompress(self._logs.getbuffer()).split(b"\n")
+
     def close(self):
+        start_time = time.perf_counter()
         self._writer.close()
+        self._compress_seconds += time.perf_counter() - start_time
 
     def flush(self):
+        start_time = time.perf_counter()
         self._writer.flush()
+        self._compress_seconds += time.perf_counter() - start_time
+        self._emitted_compress_size = self._logs.tell()
+        self._emitted_decompress_size = self._decompress_size
+
+    def http_headers(self):
+        return self._http_headers
+
+
+class ParallelGzipLogRequest(object):
+    """A gzip bulk whose blocks of logs are compressed on a thread pool while new logs are written.
+
+    Every block is compressed to a gzip member of its own, and the members are
+    concatenated, which is a valid gzip stream. Every block but the first starts
+    with the newline that separates it from the previous block.
+    """
+    # Gzip header and trailer of a member
+    GZIP_MEMBER_OVERHEAD = 18
+
+    def __init__(self, max_size_in_bytes, compresslevel, executor, block_size=COMPRESSION_BLOCK_SIZE):
+        self._max_size_in_bytes = max_size_in_bytes
+        self.compresslevel = compresslevel
+        self._executor = executor
+        self._block_size = block_size
+        self._http_headers = {"Content-Encoding": "gzip",
+                              "Content-type": "application/json"}
+        self.reset()
+
+    def __len__(self):
+        return self._logs_counter
+
+    def bytes(self):
+        self.close()
+        return self._body
+
+    def body(self):
+        # type: () -> memoryview
+        return memoryview(self.bytes())
+
+    def write(self, log):
+        # type: (str | bytes) -> None
+        data = log.encode('utf-8') if isinstance(log, str) else log
+        if self._logs_counter:
+            self._block.append(b"\n")
+            self._block_bytes += 1
+        self._block.append(data)
+        self._block_bytes += len(data)
+        self._decompress_size += len(data) + (1 if self._logs_counter else 0)
+        self._logs_counter += 1
+        if self._block_bytes >= self._block_size:
+            self._submit_block()
+
+    def _submit_block(self):
+        if not self._block_bytes:
+            return
+        self._members.append(self._executor.submit(compress_block, b"".join(self._block), self.compresslevel))
+        self._pending_sizes.append(self._block_bytes)
+        self._block = []
+        self._block_bytes = 0
+
+    def _collect_done_members(self):
+        # Members are collected in order, so the sizes stay aligned with the futures still pending
+        while self._collected < len(self._members) and self._members[self._collected].done():
+            member, _ = self._members[self._collected].result()
+            self._compress_size += len(member)
+            self._compressed_input_size += self._pending_sizes[self._collected]
+            self._collected += 1
+
+    def reset(self):
+        self._decompress_size = 0
+        self._logs_counter = 0
+        self._block = []
+        self._block_bytes = 0
+        self._members = []
+        self._pending_sizes = []
+        self._collected = 0
+        self._compress_size = 0
+        self._compressed_input_size = 0
+        self._compress_seconds = 0.0
+        self._body = None
+
+    def decompress_size(self):
+        return self._decompress_size
+
+    def compress_size(self):
+        if self._body is not None:
+            return len(self._body)
+        self._collect_done_members()
+        return self._compress_size
+
+    def compress_size_estimate(self, additional_bytes=0):
+        # type: (int) -> int
+        """Estimate the closed body size without waiting for the blocks that are still compressed.
+
+        Blocks that are not compressed yet are extrapolated with the compression
+        ratio of the blocks that are, and counted uncompressed before there are any.
+        """
+        self._collect_done_members()
+        pending_size = self._decompress_size - self._compressed_input_size + additional_bytes
+        if self._compressed_input_size:
+            pending_size = pending_size * self._compress_size // self._compressed_input_size
+        elif pending_size:
+            pending_size += self.GZIP_MEMBER_OVERHEAD
+        return self._compress_size + pending_size
+
+    def _compress_size_bound(self, additional_bytes):
+        # type: (int) -> int
+        pending_sizes = self._pending_sizes[self._collected:] + [self._block_bytes + additional_bytes]
+        return self._compress_size + sum(deflate_bound(size) + self.GZIP_MEMBER_OVERHEAD
+                                         for size in pending_sizes if size)
+
+    def fits(self, additional_bytes, max_size_in_bytes):
+        # type: (int, int) -> bool
+        """Whether the closed body stays within max_size_in_bytes after writing additional_bytes more.
+
+        Only when the estimate is too close to the limit to tell, the blocks are
+        compressed and waited for so that they are counted exactly.
+        """
+        if self._logs_counter:
+            additional_bytes += 1
+        if self.compress_size_estimate(additional_bytes) > max_size_in_bytes:
+            return False
+        if self._compress_size_bound(additional_bytes) <= max_size_in_bytes:
+            return True
+        if self._decompress_size - self._compressed_input_size < max_size_in_bytes * MIN_EXACT_COUNT_FRACTION:
+            return False
+        self._submit_block()
+        for future in self._members[self._collected:]:
+            future.result()
+        self._collect_done_members()
+        return self._compress_size_bound(additional_bytes) <= max_size_in_bytes
+
+    def compress_seconds(self):
+        return self._compress_seconds
+
+    def lines(self):
+        # type: () -> list
+        return gzip.decompress(self.bytes()).split(b"\n")
+
+    def close(self):
+        if self._body is not None:
+            return
+        self._submit_block()
+        members = []
+        for future in self._members:
+            member, seconds = future.result()
+            members.append(member)
+            self._compress_seconds += seconds
+        self._body = b"".join(members)
+        self._members = []
+        self._pending_sizes = []
+
+    def flush(self):
+        pass
 
     def http_headers(self):
         return self._http_headers
@@ -82,34 +318,64 @@ class StringLogRequest(object):
 
     def __init__(self, max_size_in_bytes):
         self._max_size_in_bytes = max_size_in_bytes
-        self._size = 0
-        self._logs = []
         self._http_headers = {"Content-type": "application/json"}
+        self.reset()
 
     def __len__(self):
-        return len(self._logs)
+        return self._logs_counter
 
     def bytes(self):
-        str_logs = "\n".join(self._logs)
-        return bytes(str_logs, 'utf-8')
+        if self._body is not None:
+            return self._body
+        return b"\n".join(self._logs)
+
+    def body(self):
+        # type: () -> memoryview
+        """The closed request body, joined once and reused by every attempt."""
+        return memoryview(self.bytes())
+
+    def lines(self):
+        # type: () -> list
+        if self._body is not None:
+            return self._body.split(b"\n")
+        return list(self._logs)
 
-    # String
     def write(self, log):
-        self._logs.append(log)
-        self._size += sys.getsizeof(log)
+        # type: (str | bytes) -> None
+        data = log.encode('utf-8') if isinstance(log, str) else log
+        if self._logs:
+            self._size += 1
+        self._logs.append(data)
+        self._size += len(data)
+        self._logs_counter += 1
 
     def reset(self):
         self._size = 0
+        self._logs_counter = 0
         self._logs = []
+        self._body = None
 
     def compress_size(self):
         return self._size
 
+    def compress_size_estimate(self, additional_bytes=0):
+        # type: (int) -> int
+        if additional_bytes and self._logs:
+            additional_bytes += 1
+        return self._size + additional_bytes
+
+    def fits(self, additional_bytes, max_size_in_bytes):
+        # type: (int, int) -> bool
+        return self.compress_size_estimate(additional_bytes) <= max_size_in_bytes
+
     def decompress_size(self):
         return self._size
 
     def close(self):
-        pass
+        # Keep only the joined body, so a closed bulk holds a single copy of its logs
+        if self._body is None:
+            self._body = b"\n".join(self._logs)
+            self._logs = []
 
     def flush(self):
         pass
@@ -118,113 +384,423 @@ class StringLogRequest(object):
         return self._http_headers
 
 
-class LogzioShipper(object):
-    MAX_BULK_SIZE_IN_BYTES = 3 * 1024 * 1024
-    ACCOUNT_TOKEN_ENV = 'TOKEN'
-    REGION_ENV = 'REGION'
-    URL_ENV = 'LISTENER_URL'
-    BASE_URL = "https://listener.logz.io:8071"
-    region = None
-    TIMEOUT_ENV = 'REQUEST_TIMEOUT'
-    default_timeout = 15  # seconds
+class GzipMembersLogRequest(object):
+    """A bulk of gzip members compressed elsewhere, sent as one concatenated gzip body."""
+    # Separates the logs of two members, which do not end with a newline
+    NEWLINE_MEMBER = gzip.compress(b"\n")
 
-    def __init__(self):
-        self._logzio_url = self.BASE_URL
+    def __init__(self, max_size_in_bytes, compresslevel=None):
+        self._max_size_in_bytes = max_size_in_bytes
+        self.compresslevel = compresslevel
+        self._http_headers = {"Content-Encoding": "gzip",
+                              "Content-type": "application/json"}
+        self.reset()
 
-        if os.environ.get(self.URL_ENV):
-            self._logzio_url = os.environ.get(self.URL_ENV)
-            logger.warning(
-                "Environment variable URL is deprecated and will not be supported in the future. Use REGION instead")
+    def __len__(self):
+        return self._logs_counter
 
-        if os.environ.get(self.REGION_ENV):
-            self.region = os.environ.get(self.REGION_ENV)
-            self._logzio_url = self.get_base_api_url()
-        try:
-            self._logzio_url = "{0}/?token={1}".format(
-                self._logzio_url, os.environ[self.ACCOUNT_TOKEN_ENV])
-        except KeyError as e:
+    def add_member(self, member, logs_count, decompress_size, compress_seconds=0.0):
+        # type: (bytes, int, int, float) -> None
+        if self._members:
+            self._members.append(self.NEWLINE_MEMBER)
+            self._size += len(self.NEWLINE_MEMBER)
+            self._decompress_size += 1
+        self._members.append(member)
+        self._size += len(member)
+        self._decompress_size += decompress_size
+        self._logs_counter += logs_count
+        self._compress_seconds += compress_seconds
+
+    def bytes(self):
+        if self._body is not None:
+            return self._body
+        return b"".join(self._members)
+
+    def body(self):
+        # type: () -> memoryview
+        return memoryview(self.bytes())
+
+    def lines(self):
+        # type: () -> list
+        return gzip.decompress(self.bytes()).split(b"\n")
+
+    def reset(self):
+        self._size = 0
+        self._decompress_size = 0
+        self._logs_counter = 0
+        self._compress_seconds = 0.0
+        self._members = []
+        self._body = None
+
+    def compress_size(self):
+        return self._size
+
+    def compress_size_estimate(self, additional_bytes=0):
+        # type: (int) -> int
+        if additional_bytes and self._members:
+            additional_bytes += len(self.NEWLINE_MEMBER)
+        return self._size + additional_bytes
+
+    def fits(self, additional_bytes, max_size_in_bytes):
+        # type: (int, int) -> bool
+        return self.compress_size_estimate(additional_bytes) <= max_size_in_bytes
+
+    def decompress_size(self):
+        return self._decompress_size
+
+    def compress_seconds(self):
+        return self._compress_seconds
+
+    def close(self):
+        if self._body is None:
+            self._body = b"".join(self._members)
+            self._members = []
+
+    def http_headers(self):
+        return self._http_headers
+
+
+class SpooledLogRequest(object):
+    """A closed bulk read back from the spool."""
+
+    def __init__(self, body, compressed, logs_count):
+        self._body = body
+        self._compressed = compressed
+        self._logs_counter = logs_count
+        self._http_headers = {"Content-Encoding": "gzip", "Content-type": "application/json"} \
+            if compressed else {"Content-type": "application/json"}
+
+    def __len__(self):
+        return self._logs_counter
+
+    def bytes(self):
+        return self._body
+
+    def body(self):
+        # type: () -> memoryview
+        return memoryview(self._body)
+
+    def lines(self):
+        # type: () -> list
+        body = gzip.decompress(self._body) if self._compressed else self._body
+        return body.split(b"\n")
+
+    def compress_size(self):
+        return len(self._body)
+
+    def close(self):
+        pass
+
+    def http_headers(self):
+        return self._http_headers
+
+
+def _tags_of_lines(tag_ranges, lines=None):
+    # type: (list, list) -> set
+    """The tags of the given lines of a bulk, or of all of its lines, from its (first line, tags) ranges."""
+    if lines is None:
+        return set(tag for _, tags in tag_ranges for tag in tags)
+    starts = [start for start, _ in tag_ranges]
+    indexes = set(bisect.bisect_right(starts, line) - 1 for line in lines)
+    # Logs added before the first tags have none
+    return set(tag for index in indexes if index >= 0 for tag in tag_ranges[index][1])
+
+
+class LogzioShipper(object):
+    MAX_BULK_SIZE_IN_BYTES = 3 * 1024 * 1024
+    ACCOUNT_TOKEN_ENV = runtime_config.ACCOUNT_TOKEN_ENV
+    REGION_ENV = runtime_config.REGION_ENV
+    URL_ENV = runtime_config.URL_ENV
+    BASE_URL = runtime_config.BASE_URL
+    region = None
+    TIMEOUT_ENV = runtime_config.TIMEOUT_ENV
+    default_timeout = runtime_config.DEFAULT_TIMEOUT
+    SENDER_THREADS_ENV = runtime_config.SENDER_THREADS_ENV
+    SENDER_QUEUE_SIZE_ENV = runtime_config.SENDER_QUEUE_SIZE_ENV
+    DEFAULT_SENDER_QUEUE_SIZE = runtime_config.DEFAULT_SENDER_QUEUE_SIZE
+    # Requests spent on isolating the logs of a bulk rejected with 400, the rest of them is dropped
+    MAX_BISECT_REQUESTS = 64
+    # Sealed bulks kept back by hold_bulks, each of them up to MAX_BULK_SIZE_IN_BYTES in memory
+    MAX_HELD_BULKS = 1
+
+    def __init__(self, context=None, track_failures=False):
+        self._context = context
+        config = runtime_config.get_config()
+        self.region = config.region
+        if config.token is None:
             logger.error(
-                "Missing logz.io account token environment variable: {}".format(e))
-            raise
-        try:
-            self._compress = os.environ['COMPRESS'].lower() == "true"
-        except KeyError as e:
-            self._compress = False
-        self._logs = GzipLogRequest(self.MAX_BULK_SIZE_IN_BYTES) \
-            if self._compress \
-            else StringLogRequest(self.MAX_BULK_SIZE_IN_BYTES)
-
-        self.timeout = self._get_timeout()
+                "Missing logz.io account token environment variable: '{}'".format(self.ACCOUNT_TOKEN_ENV))
+            raise KeyError(self.ACCOUNT_TOKEN_ENV)
+        self._logzio_url = "{0}/?token={1}".format(config.listener_url, config.token)
+        self._connection_pool = get_connection_pool(self._logzio_url, config.connection_pool_size,
+                                                    config.connection_idle_timeout)
+        self._compress = config.compress
+        self._compression_level = config.compression_level
+        # With more than one thread, blocks of a bulk are compressed in parallel
+        self._compression_threads = config.compression_threads
+        self._logs = self._new_request()
+        self._serializer = config.serializer
+
+        self.timeout = config.timeout
         logger.debug(f'Request timeout is set to: {self.timeout} seconds')
-
-    def _get_timeout(self):
-        timeout_str = os.getenv(self.TIMEOUT_ENV)
-        if timeout_str != '':
-            try:
-                timeout = int(timeout_str)
-                if timeout > 0:
-                    return timeout
-                logger.warning(f'Timeout input from user is invalid, reverting to default value {self.default_timeout}')
-            except TypeError:
-                logger.warning(f'Could not parse timeout input {timeout_str}, reverting to default value {self.default_timeout}')
-        return self.default_timeout
+        self._retry_policy = config.retry_policy.with_status_errors(STATUS_ERRORS)
+        # Bulks that fail to ship are kept in the spool and sent before new bulks of a later invocation
+        self._spool = get_spool(config.spool_dir, config.spool_max_size)
+        self._spool_replayed = False
+        # Once a bulk was spooled, the next bulks of this invocation are spooled without trying the listener
+        self._listener_unavailable = False
+
+        # When SENDER_THREADS is set, sealed bulks are sent in the background while new logs are added
+        self._sender_threads = config.sender_threads
+        self._sender_queue_size = config.sender_queue_size
+        self._sender_pool = None
+        self._sender_slots = None
+        self._pending_bulks = []
+        # After hold_bulks, the latest sealed bulks are kept here with their tags
+        self._held_bulks = None
+        self._max_held_bulks = self.MAX_HELD_BULKS
+
+        # With track_failures, a bulk that fails to ship adds the tags of its logs to failed_tags instead of raising
+        self._track_failures = track_failures
+        self._tags = ()
+        # (first line, tags) of the logs of the bulk, so the tags of any of its lines are known
+        self._bulk_tags = []
+        self._bulk_tagged = True
+        self._failed_tags_lock = threading.Lock()
+        self.failed_tags = set()
 
     def get_base_api_url(self):
-        return self.BASE_URL.replace("listener.", "listener{}.".format(self.get_region_code()))
+        return runtime_config.get_base_api_url(self.region)
 
     def get_region_code(self):
-        if self.region != "us" and self.region != "":
-            return "-{}".format(self.region)
-        return ""
+        return runtime_config.get_region_code(self.region)
 
     def add(self, log):
         # type (dict) -> None
-        json_log = json.dumps(log)
+        self._write(self._serializer.dumps(log))
+
+    def add_raw(self, log, validate=False):
+        # type (str | bytes, bool) -> None
+        """Add a log that is already serialized as a JSON object, without parsing it again.
+
+        With validate, a log that is not a JSON object raises ValueError.
+        """
+        json_log = log.encode('utf-8') if isinstance(log, str) else bytes(log)
+        if validate and not isinstance(self._serializer.loads(json_log), dict):
+            raise ValueError("Expected a JSON object but found another type")
+        if b"\n" in json_log:
+            # Outside of strings, where JSON escapes them, newlines are only whitespace
+            json_log = json_log.replace(b"\r\n", b" ").replace(b"\n", b" ")
+        self._write(json_log)
+
+    def add_many(self, logs, validate=False):
+        # type (iterable, bool) -> int
+        """Add dicts and serialized logs. With validate, invalid serialized logs are skipped.
+
+        Returns the number of logs added.
+        """
+        added = 0
+        for log in logs:
+            if isinstance(log, dict):
+                self.add(log)
+            else:
+                try:
+                    self.add_raw(log, validate)
+                except ValueError as e:
+                    logger.warning(f'Skipping log that is not a valid JSON object: {e}')
+                    metrics.increment('invalid_logs')
+                    continue
+            added += 1
+        return added
+
+    def add_gzip_member(self, member, logs_count, decompress_size, tag_ranges=None, compresslevel=None,
+                        compress_seconds=0.0):
+        # type: (bytes, int, int, list, int, float) -> None
+        """Add logs that were serialized and compressed elsewhere, as one complete gzip member.
+
+        The member holds logs_count newline separated logs, without a trailing newline.
+        tag_ranges holds the (first line in the member, tags) of its logs, which
+        otherwise get the tags of the last set_tags. Members of another compression
+        level than the bulk start a new bulk, so the level of every bulk is measured.
+        """
+        if not isinstance(self._logs, GzipMembersLogRequest) or self._logs.compresslevel != compresslevel:
+            if len(self._logs):
+                self._ship_bulk()
+            self._logs = GzipMembersLogRequest(self.MAX_BULK_SIZE_IN_BYTES, compresslevel)
+        elif len(self._logs) and not self._logs.fits(len(member), self.MAX_BULK_SIZE_IN_BYTES):
+            self._ship_bulk()
+            self._logs = GzipMembersLogRequest(self.MAX_BULK_SIZE_IN_BYTES, compresslevel)
+        if tag_ranges is not None:
+            self._bulk_tags.extend((len(self._logs) + first, tags) for first, tags in tag_ranges)
+        else:
+            self._tag_bulk()
+        self._logs.add_member(member, logs_count, decompress_size, compress_seconds)
+
+    def _write(self, json_log):
+        # type (bytes) -> None
+        if isinstance(self._logs, GzipMembersLogRequest):
+            if len(self._logs):
+                self._ship_bulk()
+            else:
+                self._logs = self._new_request()
+        # Seal the bulk before this log would push it past the maximum size
+        if len(self._logs) and not self._logs.fits(len(json_log), self.MAX_BULK_SIZE_IN_BYTES):
+            self._ship_bulk()
+        self._tag_bulk()
         self._logs.write(json_log)
-        # To prevent flush() after every log added
-        if self._logs.decompress_size() > self.MAX_BULK_SIZE_IN_BYTES:
-            self._logs.flush()
-            self._try_to_send()
-
-    def _reset(self):
-        self._logs.reset()
 
-    def _try_to_send(self):
-        if self._logs.compress_size() > self.MAX_BULK_SIZE_IN_BYTES:
-            self._send_to_logzio()
-            self._reset()
+    def set_tags(self, tags):
+        # type: (iterable) -> None
+        """The logs added from now on belong to tags, for example the records they were parsed from."""
+        self._tags = tuple(tags)
+        self._bulk_tagged = not self._tags
+
+    def _tag_bulk(self):
+        if not self._bulk_tagged:
+            self._bulk_tags.append((len(self._logs), self._tags))
+            self._bulk_tagged = True
+
+    def _new_request(self):
+        if not self._compress:
+            return StringLogRequest(self.MAX_BULK_SIZE_IN_BYTES)
+        level = self._compression_level
+        if level == AUTO_COMPRESSION_LEVEL:
+            level = compression_tuner.choose_level(self._get_remaining_time_ms())
+        if self._compression_threads > 1:
+            return ParallelGzipLogRequest(self.MAX_BULK_SIZE_IN_BYTES, level,
+                                          get_compression_executor(self._compression_threads))
+        return GzipLogRequest(self.MAX_BULK_SIZE_IN_BYTES, level)
+
+    def _get_remaining_time_ms(self):
+        try:
+            return self._context.get_remaining_time_in_millis()
+        except AttributeError:
+            return None
+
+    def hold_bulks(self, max_bulks=None):
+        # type: (int) -> None
+        """Keep back the last max_bulks sealed bulks, and send them only when more are sealed or in flush().
+
+        For input that is read while its logs are added, so that nothing is sent
+        when the input turns out to be invalid before max_bulks + 1 bulks were
+        sealed, and the whole of it is retried. Later, the oldest held bulk is
+        sent whenever a bulk is sealed, which bounds the memory of held bulks
+        and keeps sending while the input is read.
+        """
+        if self._held_bulks is None:
+            self._held_bulks = []
+        self._max_held_bulks = self.MAX_HELD_BULKS if max_bulks is None else max_bulks
 
     def flush(self):
-        if self._logs.compress_size():
-            self._logs.flush()
-            self._send_to_logzio()
-            self._reset()
+        try:
+            self._replay_spool()
+            held_bulks, self._held_bulks = self._held_bulks or [], None
+            for bulk, bulk_tags in held_bulks:
+                self._dispatch_bulk(bulk, bulk_tags)
+            if len(self._logs):
+                self._ship_bulk()
+        finally:
+            self._wait_for_senders()
+            metrics.report()
+
+    def _ship_bulk(self):
+        self._replay_spool()
+        self._logs.close()
+        bulk = self._logs
+        bulk_tags, self._bulk_tags = self._bulk_tags, []
+        self._bulk_tagged = not self._tags
+        self._logs = self._new_request()
+        if self._held_bulks is not None:
+            self._held_bulks.append((bulk, bulk_tags))
+            if len(self._held_bulks) <= self._max_held_bulks:
+                return
+            bulk, bulk_tags = self._held_bulks.pop(0)
+        self._dispatch_bulk(bulk, bulk_tags)
+
+    def _dispatch_bulk(self, bulk, bulk_tags):
+        # type: (GzipLogRequest | StringLogRequest, list) -> None
+        if not self._sender_threads:
+            self._send_bulk(bulk, bulk_tags)
+            return
+
+        self._raise_sender_errors()
+        if self._sender_pool is None:
+            self._sender_pool = ThreadPoolExecutor(max_workers=self._sender_threads)
+            self._sender_slots = threading.BoundedSemaphore(self._sender_threads + self._sender_queue_size)
+        # Blocks while the queue of sealed bulks is full
+        self._sender_slots.acquire()
+        try:
+            future = self._sender_pool.submit(self._send_bulk, bulk, bulk_tags)
+        except Exception:
+            self._sender_slots.release()
+            raise
+        future.add_done_callback(lambda _: self._sender_slots.release())
+        self._pending_bulks.append(future)
+
+    def _send_bulk(self, logs_request, tags):
+        # type: (GzipLogRequest | StringLogRequest, list) -> None
+        if not self._track_failures or not tags:
+            self._send_to_logzio(logs_request)
+            return
+        try:
+            self._send_to_logzio(logs_request)
+        except Exception as e:
+            # When the bulk was bisected, the listener already accepted some of its logs
+            failed_tags = _tags_of_lines(tags, getattr(e, 'unsent_lines', None))
+            logger.error(f'Failed to ship bulk of {len(logs_request)} logs from {len(failed_tags)} tags, '
+                         f'reporting them as failed: {type(e).__name__} {e}')
+            metrics.increment('failed_bulks')
+            with self._failed_tags_lock:
+                self.failed_tags.update(failed_tags)
+
+    def _raise_sender_errors(self):
+        for future in self._pending_bulks:
+            if future.done() and future.exception() is not None:
+                self._wait_for_senders()
+
+    def _wait_for_senders(self):
+        if self._sender_pool is None:
+            return
+        pending_bulks, self._pending_bulks = self._pending_bulks, []
+        self._sender_pool.shutdown(wait=True)
+        self._sender_pool = None
+        for future in pending_bulks:
+            error = future.exception()
+            if error is not None:
+                raise error
 
     @staticmethod
-    def retry(func):
-        def retry_func():
-            max_retries = 4
-            sleep_between_retries = 2
+    def retry(func, retry_policy=None, get_remaining_time_ms=None, reserved_seconds=0):
+        policy = retry_policy or RetryPolicy(status_errors=STATUS_ERRORS)
 
-            for retries in range(max_retries):
+        def retry_func():
+            slept = 0.0
+            retry_after = None
+            for retries in range(policy.max_attempts):
                 if retries:
-                    sleep_between_retries *= 2
-                    logger.info("Failure in sending logs - Trying again in {} seconds"
+                    remaining_time_ms = get_remaining_time_ms() if get_remaining_time_ms else None
+                    sleep_between_retries = policy.next_delay(retries, slept, remaining_time_ms, reserved_seconds,
+                                                              retry_after)
+                    if sleep_between_retries is None:
+                        logger.warning("Not enough time left in this invocation to retry sending logs")
+                        break
+                    logger.info("Failure in sending logs - Trying again in {:.2f} seconds"
                                 .format(sleep_between_retries))
                     time.sleep(sleep_between_retries)
+                    slept += sleep_between_retries
                 try:
                     res = func()
                 except urllib.error.HTTPError as e:
                     status_code = e.getcode()
-                    if status_code == 400:
-                        raise BadLogsException(e.reason)
-                    elif status_code == 401:
-                        raise UnauthorizedAccessException()
-                    elif status_code == 404:
-                        raise UnknownURL()
+                    error = policy.error_for(status_code)
+                    if error is not None:
+                        raise error(e.reason)
+                    retry_after = parse_retry_after(e.headers)
+                    if retry_after is not None:
+                        logger.warning("Listener asked to retry after {} seconds: {}".format(retry_after, e))
                     else:
                         logger.error("Unknown HTTP exception: {}".format(e))
-                        continue
+                    continue
                 except urllib.error.URLError:
                     raise
                 return res
@@ -233,27 +809,110 @@ class LogzioShipper(object):
 
         return retry_func
 
-    def _send_to_logzio(self):
-        @LogzioShipper.retry
-        def do_request():
-            self._logs.close()
-            logs = self._logs.bytes()
-            logger.info(f'About to send {len(logs)} bytes')
-            request = urllib.request.Request(self._logzio_url, data=self._logs.bytes(),
-                                             headers=self._logs.http_headers())
-            return urllib.request.urlopen(request, timeout=self.timeout)
-
+    def _get_request_timeout(self):
+        # Never let a request outlive the invocation
+        remaining_time_ms = self._get_remaining_time_ms()
+        if remaining_time_ms is None:
+            return self.timeout
+        return max(min(self.timeout, remaining_time_ms / 1000 - DEADLINE_MARGIN_SECONDS), 1)
+
+    def _get_pacing_timeout(self):
+        # Seconds a request may wait for the rate controller before the invocation ends
+        remaining_time_ms = self._get_remaining_time_ms()
+        if remaining_time_ms is None:
+            return None
+        return remaining_time_ms / 1000 - DEADLINE_MARGIN_SECONDS
+
+    def _replay_spool(self):
+        if self._spool is None or self._spool_replayed:
+            return
+        self._spool_replayed = True
+        # A single attempt per bulk, the listener may still be unavailable
+        replay_policy = RetryPolicy(max_attempts=1, status_errors=STATUS_ERRORS)
+        for path in self._spool.pending():
+            logs_request = SpooledLogRequest(*self._spool.load(path))
+            try:
+                self._send_to_logzio(logs_request, retry_policy=replay_policy, spool_on_failure=False)
+            except Exception as e:
+                logger.warning(f'Could not replay spooled bulk {path}, will try again in a later invocation: {e}')
+                unsent_lines = getattr(e, 'unsent_lines', None)
+                if unsent_lines is not None:
+                    # Keep only the logs the listener did not accept, they would be sent twice otherwise
+                    lines = logs_request.lines()
+                    if self._spool_bulk(self._request_of_lines([lines[line] for line in unsent_lines])):
+                        self._spool.remove(path)
+                return
+            self._spool.remove(path)
+            metrics.increment('replayed_bulks')
+
+    def _spool_bulk(self, logs_request):
+        # type: (GzipLogRequest | StringLogRequest) -> bool
+        if self._spool is None:
+            return False
         try:
-            do_request()
-            logger.info(
-                "Successfully sent bulk of {} logs to Logz.io!".format(len(self._logs)))
+            spooled = self._spool.store(logs_request.body(), "Content-Encoding" in logs_request.http_headers(),
+                                        len(logs_request))
+        except OSError as e:
+            logger.error(f'Failed to spool bulk: {e}')
+            return False
+        self._listener_unavailable = spooled
+        return spooled
+
+    def _post(self, logs_request, retry_policy=None):
+        # type: (GzipLogRequest | StringLogRequest, RetryPolicy) -> float
+        """Send the bulk, retrying by the policy. Returns the seconds of the attempt that succeeded."""
+        # The same view of the body is sent by every attempt
+        body = logs_request.body()
+
+        def send_request():
+            logger.info(f'About to send {body.nbytes} bytes')
+            if not rate_controller.acquire(self._get_pacing_timeout()):
+                logger.warning("Not enough time left in this invocation to wait for the allowed send rate")
+                metrics.increment('paced_past_deadline')
+                raise MaxRetriesException()
+            status_code = None
+            # Retry sleeps and pacing are left out, they say nothing about the upload bandwidth
+            start_time = time.perf_counter()
+            try:
+                response = self._connection_pool.urlopen(self._logzio_url, body,
+                                                         logs_request.http_headers(), self._get_request_timeout())
+                status_code = response.status
+                return time.perf_counter() - start_time
+            except urllib.error.HTTPError as e:
+                status_code = e.code
+                raise
+            finally:
+                rate_controller.release(status_code)
+
+        do_request = LogzioShipper.retry(send_request, retry_policy or self._retry_policy,
+                                         self._get_remaining_time_ms, self.timeout)
+        return do_request()
+
+    def _send_to_logzio(self, logs_request, retry_policy=None, spool_on_failure=True):
+        # type: (GzipLogRequest | StringLogRequest | SpooledLogRequest, RetryPolicy, bool) -> None
+        if spool_on_failure and self._listener_unavailable and self._spool_bulk(logs_request):
+            return
+        rejected = False
+        try:
+            try:
+                send_seconds = self._post(logs_request, retry_policy)
+            except BadLogsException as e:
+                logger.error("Got 400 code from Logz.io. This means that some of your logs are too big, "
+                             "or badly formatted. response: {0}".format(e))
+                rejected = True
+            else:
+                logger.info(
+                    "Successfully sent bulk of {} logs to Logz.io!".format(len(logs_request)))
+                if self._compression_level == AUTO_COMPRESSION_LEVEL and \
+                        isinstance(logs_request, (GzipLogRequest, ParallelGzipLogRequest, GzipMembersLogRequest)):
+                    compression_tuner.record(logs_request.compresslevel, logs_request.decompress_size(),
+                                             logs_request.compress_size(), logs_request.compress_seconds(),
+                                             send_seconds)
         except MaxRetriesException:
             logger.error('Retry limit reached. Failed to send log entry.')
+            if spool_on_failure and self._spool_bulk(logs_request):
+                return
             raise MaxRetriesException()
-        except BadLogsException as e:
-            logger.error("Got 400 code from Logz.io. This means that some of your logs are too big, "
-                         "or badly formatted. response: {0}".format(e))
-            logger.warning("Dropping logs that cause the bad response...")
         except UnauthorizedAccessException:
             logger.error(
                 "You are not authorized with Logz.io! Token OK? dropping logs...")
@@ -265,6 +924,78 @@ class LogzioShipper(object):
             logger.error(
                 "Unexpected error while trying to send logs: {}".format(e))
             raise
+        except urllib.error.URLError as e:
+            logger.error(e)
+            if spool_on_failure and self._spool_bulk(logs_request):
+                return
+            raise
         except Exception as e:
             logger.error(e)
             raise
+        if rejected:
+            # Outside of the handlers above, which would spool or fail the whole bulk
+            self._send_bisected(logs_request, spool_on_failure)
+
+    def _send_bisected(self, logs_request, spool_on_failure=True):
+        # type: (GzipLogRequest | StringLogRequest | SpooledLogRequest, bool) -> None
+        """Split a rejected bulk in halves until only the logs the listener rejects are left, and drop them.
+
+        If a half fails to send, only the logs that were not accepted yet are
+        spooled, or the error is raised with their line numbers in unsent_lines.
+        """
+        lines = logs_request.lines()
+        # (start, end) of the parts of lines that hold rejected logs
+        bad_parts = [(0, len(lines))]
+        requests_left = self.MAX_BISECT_REQUESTS
+        dropped = 0
+        try:
+            while bad_parts:
+                start, end = part = bad_parts.pop()
+                if end - start == 1 or requests_left <= 0:
+                    for line in lines[start:end]:
+                        logger.debug("Dropping log: {}".format(line[:1000]))
+                    dropped += end - start
+                    continue
+                middle = (start + end) // 2
+                requests_left -= 1
+                if self._post_lines(lines[start:middle]):
+                    # The first half was accepted, so the bad logs are in the second half
+                    bad_parts.append((middle, end))
+                    continue
+                bad_parts.append((start, middle))
+                part = (middle, end)
+                if requests_left <= 0:
+                    bad_parts.append(part)
+                    continue
+                requests_left -= 1
+                if not self._post_lines(lines[middle:end]):
+                    bad_parts.append(part)
+        except (MaxRetriesException, urllib.error.URLError) as e:
+            unsent_lines = [line for start, end in sorted(bad_parts + [part]) for line in range(start, end)]
+            logger.error(f'Failed to send {len(unsent_lines)} of {len(logs_request)} logs of the rejected bulk: {e}')
+            if spool_on_failure and self._spool_bulk(self._request_of_lines([lines[line] for line in unsent_lines])):
+                return
+            e.unsent_lines = unsent_lines
+            raise
+        finally:
+            metrics.increment('dropped_logs', dropped)
+            logger.warning("Dropped {} of {} logs that caused the bad response".format(dropped, len(logs_request)))
+
+    def _request_of_lines(self, lines):
+        # type: (list) -> GzipLogRequest | StringLogRequest
+        logs_request = self._new_request()
+        for line in lines:
+            logs_request.write(line)
+        logs_request.close()
+        return logs_request
+
+    def _post_lines(self, lines):
+        # type: (list) -> bool
+        """Send serialized logs as a bulk of their own. Returns False when the listener rejects them."""
+        logs_request = self._request_of_lines(lines)
+        try:
+            self._post(logs_request)
+        except BadLogsException:
+            return False
+        logger.info("Successfully sent bulk of {} logs to Logz.io!".format(len(logs_request)))
+        return True
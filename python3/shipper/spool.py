@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+import uuid
+
+from python3.custom_logger import custom_logger
+from python3.shipper.metrics import metrics
+
+SPOOL_DIR_ENV = 'SPOOL_DIR'
+SPOOL_MAX_SIZE_ENV = 'SPOOL_MAX_SIZE_MB'
+DEFAULT_SPOOL_MAX_SIZE_MB = 100
+GZIP_EXTENSION = '.gz'
+PLAIN_EXTENSION = '.json'
+TEMP_EXTENSION = '.tmp'
+
+# set logger
+logger = custom_logger.get_logger(__name__)
+
+
+class BulkSpool(object):
+    """Size-capped ring of bulk bodies that failed to ship, kept in a local directory.
+
+    File names start with the spool time so the oldest bulk is replayed, and
+    evicted, first. The number of logs in the bulk is kept in the name as well.
+    """
+
+    def __init__(self, directory, max_size_in_bytes):
+        # type: (str, int) -> None
+        self.directory = directory
+        self.max_size_in_bytes = max_size_in_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def store(self, body, compressed, logs_count):
+        # type: (bytes, bool, int) -> bool
+        size = len(body)
+        if size > self.max_size_in_bytes:
+            logger.warning(f'Bulk of {size} bytes is bigger than the whole spool, not spooling it')
+            return False
+        name = '{:020d}-{}-{}{}'.format(time.time_ns(), logs_count, uuid.uuid4().hex,
+                                         GZIP_EXTENSION if compressed else PLAIN_EXTENSION)
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            self._evict(size)
+            with open(path + TEMP_EXTENSION, 'wb') as spool_file:
+                spool_file.write(body)
+            os.replace(path + TEMP_EXTENSION, path)
+        metrics.increment('spooled_bulks')
+        logger.warning(f'Spooled bulk of {logs_count} logs to {path}')
+        return True
+
+    def _evict(self, incoming_size):
+        paths = self.pending()
+        total_size = sum(os.path.getsize(path) for path in paths)
+        while paths and total_size + incoming_size > self.max_size_in_bytes:
+            oldest = paths.pop(0)
+            total_size -= os.path.getsize(oldest)
+            os.remove(oldest)
+            metrics.increment('evicted_spooled_bulks')
+            logger.warning(f'Spool is full, dropped the oldest spooled bulk {oldest}')
+
+    def pending(self):
+        # type: () -> list
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.endswith(GZIP_EXTENSION) or name.endswith(PLAIN_EXTENSION))
+        return [os.path.join(self.directory, name) for name in names]
+
+    @staticmethod
+    def load(path):
+        # type: (str) -> (bytes, bool, int)
+        with open(path, 'rb') as spool_file:
+            body = spool_file.read()
+        logs_count = int(os.path.basename(path).split('-')[1])
+        return body, path.endswith(GZIP_EXTENSION), logs_count
+
+    def remove(self, path):
+        with self._lock:
+            os.remove(path)
+
+
+_spools = {}
+
+
+def get_spool_max_size():
+    # type: () -> int
+    """SPOOL_MAX_SIZE_MB in bytes."""
+    try:
+        max_size_mb = float(os.getenv(SPOOL_MAX_SIZE_ENV) or DEFAULT_SPOOL_MAX_SIZE_MB)
+    except ValueError:
+        logger.warning(f'Could not parse spool max size, reverting to default value {DEFAULT_SPOOL_MAX_SIZE_MB}')
+        max_size_mb = DEFAULT_SPOOL_MAX_SIZE_MB
+    return int(max_size_mb * 1024 * 1024)
+
+
+def get_spool(directory, max_size_in_bytes):
+    # type: (str | None, int) -> BulkSpool | None
+    """The spool in directory, shared by all invocations of the container, or None without a directory."""
+    if not directory:
+        return None
+    spool = _spools.get(directory)
+    if spool is None:
+        spool = BulkSpool(directory, max_size_in_bytes)
+        _spools[directory] = spool
+    spool.max_size_in_bytes = max_size_in_bytes
+    return spool
@@ -0,0 +1,77 @@
+"""Compare compressing a bulk with one gzip stream and with blocks compressed on threads.
+
+Lambda gives a function one vCPU per 1769 MB of memory, up to 6. The benchmark
+pins itself to as many CPUs as each vCPU count, when the machine has them, and
+compresses bulks of a few sizes with COMPRESSION_THREADS set to the vCPU count.
+
+Run from the repository root:
+    python -m python3.shipper.tests.compression_benchmark [level]
+"""
+import gzip
+import json
+import os
+import random
+import sys
+import timeit
+
+from python3.shipper.compression import get_compression_executor
+from python3.shipper.shipper import GzipLogRequest, LogzioShipper, ParallelGzipLogRequest
+
+BULK_SIZES_MB = (1, 8, 32)
+VCPU_COUNTS = (1, 2, 4, 6)
+
+
+def generate_lines(size):
+    # type: (int) -> list
+    lines = []
+    total = 0
+    words = ['GET', 'POST', 'user', 'order', 'payment', 'timeout', 'ok', 'retry', 'cache', 'miss']
+    while total < size:
+        line = json.dumps({'@timestamp': '2020-02-03T16:26:{:02d}.{:03d}Z'.format(len(lines) % 60, len(lines) % 1000),
+                           'requestID': '{:032x}'.format(random.getrandbits(128)),
+                           'message': ' '.join(random.choice(words) for _ in range(12)),
+                           'duration': random.randint(1, 5000)}).encode('utf-8')
+        lines.append(line)
+        total += len(line) + 1
+    return lines
+
+
+def compress(logs_request, lines):
+    for line in lines:
+        logs_request.write(line)
+    logs_request.close()
+    return logs_request.bytes()
+
+
+def main():
+    level = int(sys.argv[1]) if len(sys.argv) > 1 else 9
+    available_cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None
+    print('Compression level {}, {} CPUs available'.format(level, len(available_cpus) if available_cpus else 'unknown'))
+    for size_mb in BULK_SIZES_MB:
+        lines = generate_lines(size_mb * 1024 * 1024)
+        expected = b"\n".join(lines)
+        single_size = len(compress(GzipLogRequest(LogzioShipper.MAX_BULK_SIZE_IN_BYTES, level), lines))
+        single_seconds = min(timeit.repeat(
+            lambda: compress(GzipLogRequest(LogzioShipper.MAX_BULK_SIZE_IN_BYTES, level), lines),
+            number=1, repeat=3))
+        print('{} MB bulk: single stream {:.1f} ms, {} bytes'.format(size_mb, single_seconds * 1000, single_size))
+        for vcpus in VCPU_COUNTS:
+            if available_cpus is not None:
+                if vcpus > len(available_cpus):
+                    print('  {} vCPUs: skipped, not enough CPUs'.format(vcpus))
+                    continue
+                os.sched_setaffinity(0, available_cpus[:vcpus])
+            executor = get_compression_executor(vcpus)
+            body = compress(ParallelGzipLogRequest(LogzioShipper.MAX_BULK_SIZE_IN_BYTES, level, executor), lines)
+            assert gzip.decompress(body) == expected
+            seconds = min(timeit.repeat(
+                lambda: compress(ParallelGzipLogRequest(LogzioShipper.MAX_BULK_SIZE_IN_BYTES, level, executor), lines),
+                number=1, repeat=3))
+            print('  {} vCPUs: parallel blocks {:.1f} ms, {:.2f}x, {} bytes'.format(
+                vcpus, seconds * 1000, single_seconds / seconds, len(body)))
+        if available_cpus is not None:
+            os.sched_setaffinity(0, available_cpus)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import threading
+import time
+
+from python3.custom_logger import custom_logger
+from python3.shipper.metrics import metrics
+
+# Listener responses that mean "slow down" rather than "this bulk is bad"
+THROTTLE_STATUS_CODES = (429, 503)
+MAX_CONCURRENCY = 64
+MIN_RATE = 0.5  # requests per second
+# Once the allowed rate grows past this, requests are no longer paced
+MAX_RATE = 100.0
+INITIAL_THROTTLED_RATE = 1.0
+RATE_INCREASE_STEP = 0.5
+DECREASE_FACTOR = 0.5
+# Weight of the newest interval in the measured send rate
+SMOOTHING_FACTOR = 0.3
+
+# set logger
+logger = custom_logger.get_logger(__name__)
+
+
+class AdaptiveRateController(object):
+    """AIMD control of the request rate and of the concurrent requests to the listener.
+
+    Requests are not paced until the listener throttles. Every throttled response
+    halves the allowed rate and concurrency, and every successful response adds
+    to them again, so containers that share a listener back off together.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY):
+        self._max_concurrency = max_concurrency
+        self._condition = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        self._concurrency_limit = self._max_concurrency
+        self._successes_since_increase = 0
+        self._in_flight = 0
+        self._rate = None
+        self._measured_rate = None
+        self._last_send_time = None
+        self._next_send_time = 0.0
+
+    @property
+    def rate(self):
+        # type: () -> float | None
+        return self._rate
+
+    @property
+    def concurrency_limit(self):
+        # type: () -> int
+        return self._concurrency_limit
+
+    def acquire(self, timeout=None):
+        # type: (float) -> bool
+        """Wait for a request slot and for the paced send time.
+
+        Returns False without taking a slot when that takes longer than timeout
+        seconds, since the rate stays low across warm invocations and a paced
+        send must not outlive the invocation.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        wait = 0.0
+        with self._condition:
+            while self._in_flight >= self._concurrency_limit:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            now = time.monotonic()
+            if self._rate:
+                send_time = max(now, self._next_send_time)
+                if deadline is not None and send_time > max(now, deadline):
+                    return False
+                self._next_send_time = send_time + 1 / self._rate
+                wait = send_time - now
+            self._in_flight += 1
+            self._measure(now + wait)
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def _measure(self, send_time):
+        if self._last_send_time is not None and send_time > self._last_send_time:
+            rate = 1 / (send_time - self._last_send_time)
+            self._measured_rate = rate if self._measured_rate is None \
+                else self._measured_rate + SMOOTHING_FACTOR * (rate - self._measured_rate)
+            metrics.gauge('send_rate', round(self._measured_rate, 3))
+        self._last_send_time = send_time
+
+    def release(self, status_code=None):
+        # type: (int) -> None
+        """Release the request slot. status_code is None when no response was received."""
+        with self._condition:
+            self._in_flight -= 1
+            if status_code in THROTTLE_STATUS_CODES:
+                self._decrease()
+            elif status_code is not None and status_code < 300:
+                self._increase()
+            metrics.gauge('rate_limit', round(self._rate, 3) if self._rate else 0)
+            metrics.gauge('concurrency_limit', self._concurrency_limit)
+            self._condition.notify_all()
+
+    def _decrease(self):
+        metrics.increment('throttled_requests')
+        current_rate = self._rate or self._measured_rate or INITIAL_THROTTLED_RATE
+        self._rate = min(MAX_RATE * DECREASE_FACTOR, max(MIN_RATE, current_rate * DECREASE_FACTOR))
+        self._concurrency_limit = max(1, int(min(self._concurrency_limit, self._in_flight + 1) * DECREASE_FACTOR))
+        self._successes_since_increase = 0
+        logger.info(f'Listener is throttling, limiting to {self._rate:.2f} requests per second '
+                    f'and {self._concurrency_limit} concurrent requests')
+
+    def _increase(self):
+        if self._rate is not None:
+            self._rate += RATE_INCREASE_STEP
+            if self._rate > MAX_RATE:
+                self._rate = None
+        self._successes_since_increase += 1
+        if self._successes_since_increase >= self._concurrency_limit:
+            self._successes_since_increase = 0
+            self._concurrency_limit = min(self._max_concurrency, self._concurrency_limit + 1)
+
+
+rate_controller = AdaptiveRateController()
@@ -0,0 +1,194 @@
+import base64
+import http.client
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from python3.custom_logger import custom_logger
+
+POOL_SIZE_ENV = 'CONNECTION_POOL_SIZE'
+IDLE_TIMEOUT_ENV = 'CONNECTION_IDLE_TIMEOUT'
+DEFAULT_POOL_SIZE = 4
+DEFAULT_IDLE_TIMEOUT = 30  # seconds
+
+# Errors raised when the listener closed a kept-alive connection between requests
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                           BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+# set logger
+logger = custom_logger.get_logger(__name__)
+
+# Pools live at module level so warm Lambda invocations reuse open connections
+_pools = {}
+_pools_lock = threading.Lock()
+_ssl_context = None
+
+
+def _get_ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+def _proxy_headers(proxy):
+    # type: (urllib.parse.SplitResult) -> dict
+    if proxy.username is None:
+        return {}
+    credentials = '{}:{}'.format(urllib.parse.unquote(proxy.username), urllib.parse.unquote(proxy.password or ''))
+    return {'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')}
+
+
+class HttpResponse(object):
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def getcode(self):
+        return self.status
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP(S) connections to a single listener host, shared between bulks.
+
+    Proxies are taken from the environment, as urllib.request.urlopen takes them.
+    """
+
+    def __init__(self, scheme, host, port, max_size, idle_timeout):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _proxy_url(self):
+        # type: () -> urllib.parse.SplitResult | None
+        """The proxy to the host, from the same environment variables that urllib.request.urlopen uses."""
+        proxy = urllib.request.getproxies().get(self.scheme)
+        if not proxy or urllib.request.proxy_bypass(self.host):
+            return None
+        return urllib.parse.urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+
+    def _new_connection(self, timeout, proxy=None):
+        # type: (int, urllib.parse.SplitResult) -> http.client.HTTPConnection
+        if proxy is not None:
+            # CONNECT tunnel through the proxy, TLS is still negotiated with the listener host
+            conn = http.client.HTTPSConnection(proxy.hostname, proxy.port or 80, timeout=timeout,
+                                               context=_get_ssl_context())
+            conn.set_tunnel(self.host, self.port, headers=_proxy_headers(proxy))
+            return conn
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout,
+                                               context=_get_ssl_context())
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def _acquire(self, timeout, proxy=None):
+        # type: (int, urllib.parse.SplitResult) -> (http.client.HTTPConnection, bool)
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        return self._new_connection(timeout, proxy), False
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def idle_count(self):
+        with self._lock:
+            return len(self._idle)
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+    def urlopen(self, url, body, headers, timeout):
+        # type: (str, bytes | memoryview, dict, int) -> HttpResponse
+        """POST body to url, raising urllib errors the same way urllib.request.urlopen does."""
+        proxy = self._proxy_url()
+        if proxy is not None and not (self.scheme == 'https' and proxy.scheme == 'http'):
+            # Only an HTTPS listener behind an HTTP proxy is tunneled on pooled connections
+            return self._urlopen_without_pool(url, body, headers, timeout)
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = '{}?{}'.format(path, parsed.query)
+        conn, reused = self._acquire(timeout, proxy)
+        try:
+            try:
+                response, data = self._request(conn, path, body, headers)
+            except STALE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+                logger.debug('Kept-alive connection was closed by the listener, reconnecting')
+                conn.close()
+                conn = self._new_connection(timeout, proxy)
+                response, data = self._request(conn, path, body, headers)
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise urllib.error.URLError(e)
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        result = HttpResponse(response.status, response.reason, response.headers, data)
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+        return result
+
+    @staticmethod
+    def _urlopen_without_pool(url, body, headers, timeout):
+        # type: (str, bytes | memoryview, dict, int) -> HttpResponse
+        request = urllib.request.Request(url, data=body, headers=headers)
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return HttpResponse(response.status, response.reason, response.headers, response.read())
+
+    def _request(self, conn, path, body, headers):
+        conn.request('POST', path, body=body, headers=headers)
+        response = conn.getresponse()
+        # The response must be drained before the connection can be reused
+        data = response.read()
+        return response, data
+
+
+def get_connection_pool(url, pool_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    # type: (str, int, int) -> ConnectionPool
+    """The pool of connections to the host of url. The sizes of the first call for a host are kept."""
+    parsed = urllib.parse.urlsplit(url)
+    scheme = parsed.scheme.lower()
+    port = parsed.port or (443 if scheme == 'https' else 80)
+    key = (scheme, parsed.hostname, port)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(scheme, parsed.hostname, port, pool_size, idle_timeout)
+            _pools[key] = pool
+    return pool
+
+
+def close_all_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.clear()